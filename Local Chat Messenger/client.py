@@ -22,9 +22,26 @@ try:
     # メッセージをサーバーに送信
     sock.sendall(message.encode('utf-8'))
 
+    # 送信完了をサーバーに伝える（サーバーは応答後に接続を閉じる）
+    sock.shutdown(socket.SHUT_WR)
+
     # サーバーからの応答を待つ
-    data = sock.recv(1024)
-    print('Received response from server:', data.decode('utf-8'))
+    # 事前確保したバッファへ recv_into で直接受信し、接続が閉じられるまで読み続ける
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        if total == len(buf):
+            # バッファが満杯なら倍に拡張する
+            view.release()
+            buf.extend(bytes(len(buf)))
+            view = memoryview(buf)
+        n = sock.recv_into(view[total:])
+        if not n:
+            break
+        total += n
+    view.release()
+    print('Received response from server:', buf[:total].decode('utf-8'))
 
 finally:
     # ソケットを閉じる
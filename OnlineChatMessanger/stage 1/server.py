@@ -1,5 +1,6 @@
 import socket
 import time
+import heapq
 
 # 定数
 SERVER_ADDRESS = '0.0.0.0'
@@ -8,7 +9,18 @@ BUFFER_SIZE = 4096
 TIMEOUT = 10  # クライアントのタイムアウト秒数
 
 # クライアントの接続管理
-clients = {}
+clients = {}  # アドレス -> 最後にメッセージを受信した時刻
+expiry_heap = []  # (有効期限, アドレス) の最小ヒープ
+
+def expire_clients(now):
+    """有効期限を過ぎたクライアントだけをヒープの先頭から取り除く"""
+    while expiry_heap and expiry_heap[0][0] < now:
+        _, address = heapq.heappop(expiry_heap)
+        last_active = clients.get(address)
+        # その後にメッセージを受信していれば、より新しいエントリがヒープに残っている
+        if last_active is not None and last_active + TIMEOUT < now:
+            print(f'Client {address} timed out')
+            del clients[address]  # タイムアウトしたクライアントを削除
 
 def handle_client_message(data, address):
     """クライアントからのメッセージを処理し、他のクライアントにリレーする"""
@@ -19,14 +31,14 @@ def handle_client_message(data, address):
     print(f'Received message from {username} ({address}): {message}')
     
     # クライアントをリストに保存（最後にメッセージを受信した時間を記録）
-    clients[address] = time.time()
+    # time.monotonic() はシステム時刻の変更に影響されない
+    now = time.monotonic()
+    clients[address] = now
+    heapq.heappush(expiry_heap, (now + TIMEOUT, address))
+    expire_clients(now)
     
     # メッセージを他のクライアントにリレー
-    for client, last_active in list(clients.items()):
-        if time.time() - last_active > TIMEOUT:
-            print(f'Client {client} timed out')
-            del clients[client]  # タイムアウトしたクライアントを削除
-            continue
+    for client in clients:
         if client != address:  # 自分以外のクライアントに送信
             sock.sendto(data, client)
 
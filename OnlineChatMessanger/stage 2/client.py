@@ -1,4 +1,5 @@
 import socket
+import struct
 import threading
 import asyncio
 import signal
@@ -8,6 +9,8 @@ import sys
 BUFFER_SIZE = 4096
 SERVER_TCP_PORT = 9001
 SERVER_UDP_PORT = 9002
+UDP_SOCKET_BUFFER_SIZE = 12 * 1024 * 1024  # Capped by net.core.rmem_max / net.core.wmem_max on Linux
+PACKET_HEADER = struct.Struct('<BB')  # Chat packet prefix: room name size, token size
 shutdown_event = threading.Event()  # Event for signaling shutdown across threads
 
 def create_udp_socket():
@@ -18,8 +21,45 @@ def create_udp_socket():
         udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Allow reuse of the port (if supported)
     except AttributeError:
         pass  # Ignore if the platform does not support SO_REUSEPORT
+    # Large kernel buffers absorb bursts instead of silently dropping datagrams
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER_SIZE)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SOCKET_BUFFER_SIZE)
     return udp_sock
 
+class ChatProtocol(asyncio.DatagramProtocol):
+    """Display chat messages relayed by the server."""
+
+    def __init__(self, token):
+        """
+        Args:
+            token (bytes): The user's token, used to skip our own messages.
+        """
+        self.token = token
+
+    def datagram_received(self, data, addr):
+        """Parse a relayed packet and print it unless it came from this user."""
+        try:
+            # Extract room name size, token size, room name, token, and message from the received data
+            room_name_size, token_size = PACKET_HEADER.unpack_from(data)
+            header_end = 2 + room_name_size + token_size
+            view = memoryview(data)
+            token_received = view[2 + room_name_size:header_end]
+
+            # Skip displaying messages from self
+            if token_received != self.token:
+                room_name_received = str(view[2:2 + room_name_size], 'utf-8')
+                message = str(view[header_end:], 'utf-8')
+                print(f"\r[{room_name_received}] {str(token_received, 'utf-8')}: {message}")  # Print received message
+                print("Message: ", end='', flush=True)  # Prompt for the next message input
+        except Exception as e:
+            if not shutdown_event.is_set():
+                print(f"\nError receiving message: {e}")
+
+    def error_received(self, exc):
+        """Report socket errors (e.g. ICMP port unreachable) without stopping the client."""
+        if not shutdown_event.is_set():
+            print(f"\nError receiving message: {exc}")
+
 def tcp_connect(server_address, room_name, operation):
     """Create or join a chat room via TCP.
 
@@ -33,10 +73,13 @@ def tcp_connect(server_address, room_name, operation):
     """
     tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a TCP socket
     tcp_sock.settimeout(5)  # Set a timeout for the connection attempt
+    tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send the small request immediately
     
     try:
         # Attempt to connect to the server at the specified address and port
         tcp_sock.connect((server_address, SERVER_TCP_PORT))
+        if hasattr(socket, 'TCP_QUICKACK'):
+            tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)  # ACK the reply without delay (Linux)
         print(f"Connected to server at {server_address}:{SERVER_TCP_PORT}")
     except socket.timeout:
         print("Connection timed out.")
@@ -86,70 +129,65 @@ async def udp_chat(server_address, token, room_name, local_port):
         udp_sock.bind(('', 0))  # Bind to any available port if the specified port fails
         print(f"UDP bound to port {udp_sock.getsockname()[1]}")
 
-    async def receive_messages():
-        """Asynchronously receive messages from the UDP socket."""
-        while not shutdown_event.is_set():  # Loop until shutdown is signaled
-            try:
-                # Use an executor to receive messages in a non-blocking way
-                data = await asyncio.get_event_loop().run_in_executor(
-                    None, 
-                    lambda: udp_sock.recv(BUFFER_SIZE)
-                )
-                
-                if data:
-                    # Extract room name size, token size, room name, token, and message from the received data
-                    room_name_size = data[0]
-                    token_size = data[1]
-                    room_name_received = data[2:2 + room_name_size].decode('utf-8')
-                    token_received = data[2 + room_name_size:2 + room_name_size + token_size]
-                    message = data[2 + room_name_size + token_size:].decode('utf-8')
-                    
-                    # Skip displaying messages from self
-                    if token_received != token:
-                        print(f"\r[{room_name_received}] {token_received.decode('utf-8')}: {message}")  # Print received message
-                        print("Message: ", end='', flush=True)  # Prompt for the next message input
-            except Exception as e:
-                if not shutdown_event.is_set():
-                    print(f"\nError receiving message: {e}")
-
-    receive_task = asyncio.create_task(receive_messages())  # Start receiving messages asynchronously
+    # Datagrams are delivered straight from the event loop to the protocol callback
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: ChatProtocol(token), sock=udp_sock)
+
+    # The packet prefix (sizes, room name, token) is the same for every message, so build it once
+    room_name_bytes = room_name.encode('utf-8')  # Encode room name to bytes
+    packet_prefix = bytes([len(room_name_bytes), len(token)]) + room_name_bytes + token
+    server_udp_address = (server_address, SERVER_UDP_PORT)
+
+    quit_event = asyncio.Event()  # Set on /quit or end of input
 
+    def send_message(message):
+        """Send one chat message to the server."""
+        message_bytes = message.encode('utf-8')  # Message content
+        try:
+            if not hasattr(udp_sock, 'sendmsg'):
+                raise BlockingIOError  # No scatter/gather support; use the transport instead
+            # Scatter/gather send: the kernel joins prefix and message, no user-space copy
+            udp_sock.sendmsg([packet_prefix, message_bytes], [], 0, server_udp_address)
+        except BlockingIOError:
+            transport.sendto(packet_prefix + message_bytes, server_udp_address)  # Queued by the transport
+
+    def handle_line(line):
+        """Handle one line of user input on the event loop."""
+        message = line.rstrip('\n')
+        if not line or message.lower() == '/quit':  # Check for quit command or end of input
+            quit_event.set()
+            return
+        try:
+            send_message(message)
+        except Exception as e:
+            if not shutdown_event.is_set():
+                print(f"\nError sending message: {e}")
+        print("Message: ", end='', flush=True)  # Prompt for the next message input
+
+    # Stdin readiness wakes the event loop directly; no executor thread per message
+    print("Message: ", end='', flush=True)
+    stdin_fd = sys.stdin.fileno()
     try:
-        while not shutdown_event.is_set():  # Loop until shutdown is signaled
-            try:
-                # Use an executor to get user input in a non-blocking way
-                message = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: input("Message: ")
-                )
-                
-                if message.lower() == '/quit':  # Check for quit command
-                    break  # Exit the loop if quit is requested
-                    
-                # Prepare the packet to send to the server
-                room_name_bytes = room_name.encode('utf-8')  # Encode room name to bytes
-                token_size = len(token)  # Get the size of the token
-                
-                packet = (
-                    bytes([len(room_name_bytes)]) +  # Room name length
-                    bytes([token_size]) +  # Token length
-                    room_name_bytes +  # Room name
-                    token +  # User token
-                    message.encode('utf-8')  # Message content
-                )
-                
-                udp_sock.sendto(packet, (server_address, SERVER_UDP_PORT))  # Send the packet to the server
-            except Exception as e:
-                if not shutdown_event.is_set():
-                    print(f"\nError sending message: {e}")
+        loop.add_reader(stdin_fd, lambda: handle_line(sys.stdin.readline()))
+        watching_stdin = True
+    except NotImplementedError:
+        # The loop cannot watch stdin (e.g. Windows); read it on one background thread instead
+        threading.Thread(target=read_stdin_lines, args=(loop, handle_line), daemon=True).start()
+        watching_stdin = False
+
+    try:
+        await quit_event.wait()  # Run until the user quits
     finally:
+        if watching_stdin:
+            loop.remove_reader(stdin_fd)
         shutdown_event.set()  # Signal shutdown
-        receive_task.cancel()  # Cancel the receiving task
-        try:
-            await receive_task  # Wait for the receiving task to finish
-        except asyncio.CancelledError:
-            pass
-        udp_sock.close()  # Close the UDP socket
+        transport.close()  # Stop receiving and close the UDP socket
+
+def read_stdin_lines(loop, handle_line):
+    """Forward stdin lines to the event loop from a worker thread."""
+    for line in sys.stdin:
+        loop.call_soon_threadsafe(handle_line, line)
+    loop.call_soon_threadsafe(handle_line, '')  # End of input
 
 def cleanup_client():
     """Cleanup client resources."""
@@ -1,30 +1,62 @@
 import socket
-import threading
 import asyncio
+import multiprocessing
 import signal
 import sys
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
 
 # Constants for the TCP and UDP ports, and buffer size for data transmission
 SERVER_TCP_PORT = 9001  # Port for TCP connections
 SERVER_UDP_PORT = 9002  # Port for UDP communications
 BUFFER_SIZE = 4096  # Buffer size for receiving data
+RECV_BATCH = 64  # Maximum number of datagrams fetched per recvmmsg call
+SEND_BATCH = 32  # Maximum number of datagrams handed to one sendmmsg call
+DEBUG = False  # Print every relayed packet (slow at high packet rates)
+TCP_BACKLOG = 128  # Pending TCP connections queued by the kernel
+# Kernel socket buffer size for the UDP socket. Linux caps this at net.core.rmem_max /
+# net.core.wmem_max, so raise those too: sysctl -w net.core.rmem_max=12582912 net.core.wmem_max=12582912
+UDP_SOCKET_BUFFER_SIZE = 12 * 1024 * 1024
+PACKET_HEADER = struct.Struct('<BB')  # Chat packet prefix: room name size, token size
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)  # Linux: report dropped-datagram counter as ancillary data
+SO_NO_CHECK = getattr(socket, 'SO_NO_CHECK', 11)  # Linux: send IPv4 UDP datagrams without a checksum
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)  # Linux 5.0+: deliver coalesced same-flow datagrams in one read
+GRO_BUFFER_SIZE = 65535  # A coalesced GRO read can carry up to one maximum-size IP packet
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)  # Linux: busy-poll the NIC queue (NAPI) on receive
+# Microseconds to busy-poll the NIC before sleeping; 0 disables. Raising it needs CAP_NET_ADMIN
+# unless net.core.busy_read already allows the value.
+BUSY_POLL_USEC = int(os.environ.get('CHAT_BUSY_POLL_USEC', '0'))
+# Network interface carrying chat traffic (e.g. "eth0"). When set, the server pins itself to
+# the CPUs of that NIC's NUMA node. Steer the NIC's IRQs to the same node, e.g. in the unit file:
+#   ExecStartPre=/bin/sh -c 'for irq in $(grep eth0 /proc/interrupts | cut -d: -f1); do echo <mask> > /proc/irq/$irq/smp_affinity; done'
+NIC_INTERFACE = os.environ.get('CHAT_NIC_INTERFACE')
+# Number of UDP relay processes. Above 1, each process binds its own SO_REUSEPORT socket and
+# the kernel spreads clients across them; the main process keeps the TCP control plane.
+UDP_WORKERS = int(os.environ.get('CHAT_UDP_WORKERS', '1'))
 
 # Dictionaries to hold chat room information and client connections
-chat_rooms = {}  # Maps room names to their members
+chat_rooms = {}  # Maps room names to {token: (address, sockaddr_in)} of their members
 clients = {}  # Maps client addresses to their connection details
-shutdown_event = threading.Event()  # Event to signal server shutdown
+shutdown_event = asyncio.Event()  # Event to signal server shutdown
+udp_workers = []  # UDP relay processes (only when UDP_WORKERS > 1)
+member_update_pipes = []  # Control-plane ends of the pipes that replicate chat_rooms to the workers
 
 """
 chat_rooms = {
-    "room1": [
-        (b"host_192.168.1.100", ("192.168.1.100", 54321)),
-        (b"guest_192.168.1.101_1", ("192.168.1.101", 54322))
-    ],
-    "game_room": [
-        (b"host_192.168.1.200", ("192.168.1.200", 54323)),
-        (b"guest_192.168.1.201_1", ("192.168.1.201", 54324)),
-        (b"guest_192.168.1.202_2", ("192.168.1.202", 54325))
-    ]
+    "room1": {
+        b"host_192.168.1.100": (("192.168.1.100", 54321), <sockaddr_in>),
+        b"guest_192.168.1.101_1": (("192.168.1.101", 54322), <sockaddr_in>)
+    },
+    "game_room": {
+        b"host_192.168.1.200": (("192.168.1.200", 54323), <sockaddr_in>),
+        b"guest_192.168.1.201_1": (("192.168.1.201", 54324), <sockaddr_in>),
+        b"guest_192.168.1.202_2": (("192.168.1.202", 54325), <sockaddr_in>)
+    }
 }
 """
 """
@@ -42,6 +74,288 @@ clients = {
 }
 """
 
+# Linux batched datagram I/O (recvmmsg) bound through ctypes
+class iovec(ctypes.Structure):
+    """struct iovec from <sys/uio.h>."""
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),  # Start of the buffer
+        ("iov_len", ctypes.c_size_t),  # Length of the buffer
+    ]
+
+class sockaddr_in(ctypes.Structure):
+    """struct sockaddr_in from <netinet/in.h>."""
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),  # Address family (AF_INET)
+        ("sin_port", ctypes.c_uint16),  # Port in network byte order
+        ("sin_addr", ctypes.c_uint8 * 4),  # IPv4 address in network byte order
+        ("sin_zero", ctypes.c_uint8 * 8),  # Padding to sizeof(struct sockaddr)
+    ]
+
+def make_sockaddr(addr):
+    """Pack a (host, port) tuple into a sockaddr_in once, for reuse on every send."""
+    sockaddr = sockaddr_in()
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port = socket.htons(addr[1])
+    sockaddr.sin_addr[:] = socket.inet_aton(addr[0])
+    return sockaddr
+
+class msghdr(ctypes.Structure):
+    """struct msghdr from <sys/socket.h>."""
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),  # Source/destination address
+        ("msg_namelen", ctypes.c_uint32),  # Size of the address buffer
+        ("msg_iov", ctypes.POINTER(iovec)),  # Scatter/gather array
+        ("msg_iovlen", ctypes.c_size_t),  # Number of iovec entries
+        ("msg_control", ctypes.c_void_p),  # Ancillary data
+        ("msg_controllen", ctypes.c_size_t),  # Size of the ancillary data buffer
+        ("msg_flags", ctypes.c_int),  # Flags on the received message
+    ]
+
+class mmsghdr(ctypes.Structure):
+    """struct mmsghdr used by recvmmsg(2)/sendmmsg(2)."""
+    _fields_ = [
+        ("msg_hdr", msghdr),  # Message header
+        ("msg_len", ctypes.c_uint),  # Number of bytes transferred
+    ]
+
+def load_libc():
+    """Load libc with errno support, or return None if it cannot be found."""
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    try:
+        return ctypes.CDLL(libc_name, use_errno=True)
+    except OSError:
+        return None
+
+libc = load_libc()
+HAS_RECVMMSG = sys.platform.startswith('linux') and hasattr(libc, 'recvmmsg')
+if HAS_RECVMMSG:
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+HAS_SENDMMSG = sys.platform.startswith('linux') and hasattr(libc, 'sendmmsg')
+if HAS_SENDMMSG:
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
+
+CMSG_HEADER = struct.Struct('@Nii')  # struct cmsghdr: cmsg_len, cmsg_level, cmsg_type
+
+def iter_cmsgs(control, length):
+    """Yield (level, type, data) for every control message in an ancillary data buffer."""
+    offset = 0
+    while offset + CMSG_HEADER.size <= length:
+        cmsg_len, level, cmsg_type = CMSG_HEADER.unpack_from(control, offset)
+        if cmsg_len < socket.CMSG_LEN(0):
+            break  # Malformed control message
+        yield level, cmsg_type, bytes(control[offset + socket.CMSG_LEN(0):offset + cmsg_len])
+        offset += socket.CMSG_SPACE(cmsg_len - socket.CMSG_LEN(0))
+
+class BatchReceiver:
+    """Receive up to RECV_BATCH datagrams per syscall with recvmmsg(2).
+
+    All buffers and message headers are allocated once and reused for every call, so
+    the returned data are memoryviews that stay valid only until the next receive().
+    """
+
+    # Room for the SO_RXQ_OVFL drop counter and the UDP_GRO segment size
+    CONTROL_SIZE = 2 * socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+
+    def __init__(self, batch_size=RECV_BATCH, buffer_size=BUFFER_SIZE):
+        self.batch_size = batch_size
+        self.dropped = 0  # Last kernel drop counter reported through SO_RXQ_OVFL
+        self.used = batch_size  # Headers the kernel filled in on the previous call
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]  # One receive buffer per message
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.addrs = (sockaddr_in * batch_size)()  # Source address of each message
+        self.iovecs = (iovec * batch_size)()
+        self.msgvec = (mmsghdr * batch_size)()
+        self.c_buffers = [(ctypes.c_char * buffer_size).from_buffer(buf) for buf in self.buffers]  # Pin the buffers
+        self.controls = [ctypes.create_string_buffer(self.CONTROL_SIZE) for _ in range(batch_size)]  # Ancillary data
+        for i, c_buf in enumerate(self.c_buffers):
+            self.iovecs[i].iov_base = ctypes.addressof(c_buf)
+            self.iovecs[i].iov_len = buffer_size
+            hdr = self.msgvec[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.addrs[i])
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = ctypes.addressof(self.controls[i])
+
+    def read_control(self, hdr, control):
+        """Handle a message's ancillary data and return its GRO segment size (0 if not coalesced).
+
+        Datagrams the kernel dropped because the receive queue overflowed are logged.
+        """
+        segment_size = 0
+        for level, cmsg_type, value in iter_cmsgs(control.raw, hdr.msg_controllen):
+            if len(value) < 4:
+                continue
+            if level == socket.SOL_SOCKET and cmsg_type == SO_RXQ_OVFL:
+                dropped = int.from_bytes(value[:4], sys.byteorder)
+                if dropped != self.dropped:
+                    print(f"Kernel dropped {(dropped - self.dropped) & 0xFFFFFFFF} datagrams (receive queue overflow)")
+                    self.dropped = dropped
+            elif level == SOL_UDP and cmsg_type == UDP_GRO:
+                segment_size = int.from_bytes(value[:4], sys.byteorder)
+        return segment_size
+
+    def receive(self, udp_sock):
+        """Return a list of (data, addr) pairs for all datagrams currently queued."""
+        msgvec = self.msgvec
+        # Only headers the kernel wrote to last time need their in/out lengths reset
+        namelen, controllen = ctypes.sizeof(sockaddr_in), self.CONTROL_SIZE
+        for i in range(self.used):
+            hdr = msgvec[i].msg_hdr
+            hdr.msg_namelen = namelen
+            hdr.msg_controllen = controllen
+        count = libc.recvmmsg(udp_sock.fileno(), msgvec, self.batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            self.used = 0  # Nothing was written
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []  # Nothing queued (or interrupted); wait for the next readiness event
+            raise OSError(err, os.strerror(err))
+        self.used = count
+
+        datagrams = []
+        append = datagrams.append
+        views, addrs, controls = self.views, self.addrs, self.controls
+        inet_ntoa, ntohs = socket.inet_ntoa, socket.ntohs
+        for i in range(count):
+            msg = msgvec[i]
+            hdr = msg.msg_hdr
+            segment_size = self.read_control(hdr, controls[i]) if hdr.msg_controllen else 0
+            addr = addrs[i]
+            source = (inet_ntoa(bytes(addr.sin_addr)), ntohs(addr.sin_port))
+            data = views[i][:msg.msg_len]  # No copy; the buffer is reused on the next call
+            if segment_size and len(data) > segment_size:
+                # GRO merged several equal-sized datagrams from this sender; split them again
+                datagrams.extend((data[offset:offset + segment_size], source)
+                                 for offset in range(0, len(data), segment_size))
+            else:
+                append((data, source))
+        return datagrams
+
+class BatchSender:
+    """Send one packet to many addresses with as few sendmmsg(2) calls as possible.
+
+    The message headers are allocated once; every entry shares the same packet buffer
+    and points straight at the member's cached sockaddr_in.
+    """
+
+    def __init__(self, batch_size=SEND_BATCH):
+        self.batch_size = batch_size
+        self.iovecs = (iovec * batch_size)()
+        self.msgvec = (mmsghdr * batch_size)()
+        for i in range(batch_size):
+            hdr = self.msgvec[i].msg_hdr
+            hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def send(self, udp_sock, packet, members):
+        """Send packet to every (token, (addr, sockaddr)) member, reporting per-member failures."""
+        packet_len = len(packet)
+        try:
+            packet_buf = (ctypes.c_char * packet_len).from_buffer(packet)  # Point at the receive buffer itself
+        except TypeError:
+            packet_buf = ctypes.create_string_buffer(bytes(packet), packet_len)  # Read-only input; copy once
+        packet_addr = ctypes.addressof(packet_buf)  # Shared by every iovec
+        for start in range(0, len(members), self.batch_size):
+            chunk = members[start:start + self.batch_size]
+            for i, (_, (_, sockaddr)) in enumerate(chunk):
+                self.iovecs[i].iov_base = packet_addr
+                self.iovecs[i].iov_len = packet_len
+                self.msgvec[i].msg_hdr.msg_name = ctypes.addressof(sockaddr)  # Prebuilt at join time
+            self._send_chunk(udp_sock, chunk)
+
+    def _send_chunk(self, udp_sock, chunk):
+        """Submit one prepared chunk, retrying the unsent tail after partial sends."""
+        sent = 0
+        while sent < len(chunk):
+            count = libc.sendmmsg(udp_sock.fileno(), ctypes.byref(self.msgvec[sent]), len(chunk) - sent, 0)
+            if count >= 0:
+                sent += count
+                continue
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue  # Interrupted before anything was sent; retry
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                select.select([], [udp_sock], [], 1.0)  # Send buffer full; wait until writable
+                continue
+            member_token, _ = chunk[sent]
+            print(f"Error sending to {member_token.decode('utf-8')}: {os.strerror(err)}")  # Skip this member
+            sent += 1
+
+def enable_busy_poll(udp_sock, usec):
+    """Busy-poll the NIC receive queue for up to usec microseconds; return True on success."""
+    if usec <= 0 or not sys.platform.startswith('linux'):
+        return False
+    try:
+        udp_sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, usec)
+    except OSError as e:
+        print(f"Busy polling not enabled: {e}")  # Usually EPERM without CAP_NET_ADMIN
+        return False
+    return True
+
+def enable_udp_gro(udp_sock):
+    """Turn on UDP generic receive offload; return True if the kernel accepted it."""
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        udp_sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False  # Kernel older than 5.0
+    return True
+
+class SimpleReceiver:
+    """Portable receiver: one datagram per syscall into a single reused buffer."""
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer = bytearray(buffer_size)  # Allocated once, like BatchReceiver's pool
+        self.view = memoryview(self.buffer)
+
+    def receive(self, udp_sock):
+        """Return [(data, addr)] for one datagram; data is valid until the next receive()."""
+        nbytes, addr = udp_sock.recvfrom_into(self.buffer)
+        return [(self.view[:nbytes], addr)]
+
+def parse_cpu_list(text):
+    """Parse a sysfs CPU list such as "0-3,8-11" into a set of CPU numbers."""
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+def nic_numa_cpus(iface):
+    """Return the CPUs of the NUMA node local to a network interface, or None if unknown."""
+    try:
+        with open(f'/sys/class/net/{iface}/device/numa_node') as f:
+            node = int(f.read())
+        if node < 0:
+            return None  # Single-node machine or the NIC reports no locality
+        with open(f'/sys/devices/system/node/node{node}/cpulist') as f:
+            return parse_cpu_list(f.read())
+    except (OSError, ValueError):
+        return None
+
+def pin_to_nic_numa_node(iface):
+    """Restrict this process to the NUMA node of iface; return the CPUs used or None."""
+    if not iface or not hasattr(os, 'sched_setaffinity'):
+        return None
+    cpus = nic_numa_cpus(iface)
+    if not cpus:
+        print(f"NUMA node of {iface} unknown; not pinning")
+        return None
+    allowed = cpus & os.sched_getaffinity(0)  # Stay within any existing cpuset restriction
+    if not allowed:
+        return None
+    os.sched_setaffinity(0, allowed)
+    print(f"Pinned server to CPUs {sorted(allowed)} local to {iface}")
+    return allowed
+
 def create_tcp_socket():
     """Create and configure a TCP socket with proper options."""
     tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a TCP socket
@@ -50,6 +364,7 @@ def create_tcp_socket():
         tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Allow port reuse if supported
     except AttributeError:
         pass  # Ignore if the platform does not support SO_REUSEPORT
+    tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Send small replies without Nagle delay
     return tcp_sock  # Return the configured TCP socket
 
 def create_udp_socket():
@@ -60,155 +375,285 @@ def create_udp_socket():
         udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Allow port reuse if supported
     except AttributeError:
         pass  # Ignore if the platform does not support SO_REUSEPORT
+    # Large kernel buffers absorb bursts instead of silently dropping datagrams
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER_SIZE)
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SOCKET_BUFFER_SIZE)
+    if sys.platform.startswith('linux'):
+        try:
+            udp_sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)  # Report kernel drops with each datagram
+        except OSError:
+            pass  # Ignore if the kernel does not support SO_RXQ_OVFL
+        try:
+            # Relayed packets are already checked by room/token lookup; skip the UDP checksum on send
+            udp_sock.setsockopt(socket.SOL_SOCKET, SO_NO_CHECK, 1)
+        except OSError:
+            pass  # Ignore if the kernel does not support SO_NO_CHECK
     return udp_sock  # Return the configured UDP socket
 
-async def udp_chat_handler():
-    """Handle incoming UDP chat messages and manage member communications."""
-    udp_sock = create_udp_socket()  # Create a UDP socket
+def send_to_members(udp_sock, packet, members, sender):
+    """Fan a packet out to all members, batched with sendmmsg when available."""
+    if sender is not None:
+        sender.send(udp_sock, packet, members)
+        return
+    for member_token, (member_addr, _) in members:  # Portable fallback: one sendto per member
+        try:
+            udp_sock.sendto(packet, member_addr)  # Send the message packet
+        except Exception as e:
+            print(f"Error sending to {member_token.decode('utf-8')}: {e}")  # Handle errors during sending
+
+def relay_message(udp_sock, data, addr, sender=None):
+    """Parse a chat packet and relay it to every member of its room.
+
+    The relayed packet is identical to the received one, so the received bytes are
+    forwarded as-is instead of being decoded and re-encoded.
+    """
+    # Parse the received packet without copying the variable-length fields
+    room_name_size, token_size = PACKET_HEADER.unpack_from(data)  # Room name size, sender token size
+    header_end = 2 + room_name_size + token_size  # Message content starts here
+    view = memoryview(data)
+    room_name = str(view[2:2 + room_name_size], 'utf-8')  # Extract room name (needed for the room lookup)
+    sender_token = bytes(view[2 + room_name_size:header_end])  # Extract sender's token
+
+    if DEBUG:
+        print(f"\nReceived message in room {room_name}")  # Notify of the received message
+        print(f"From: {sender_token.decode('utf-8')} at {addr}")  # Display sender's token and address
+        print(f"Message: {str(view[header_end:], 'utf-8', 'replace')}")  # Display the message content
+
+    # Check if the room exists in the chat_rooms dictionary
+    members = chat_rooms.get(room_name)  # Get members of the chat room
+    if members is None:
+        if DEBUG:
+            print(f"Room {room_name} not found")  # Notify if room does not exist
+        udp_sock.sendto(b"Room not found", addr)  # Send error message back to sender
+        return
+
+    if sender_token not in members:
+        if DEBUG:
+            print(f"Unknown token {sender_token!r} for room {room_name}")  # Only members may post
+        return
+
+    # Everyone except the sender receives the message
+    recipients = [(token, member) for token, member in members.items() if token != sender_token]
+    if DEBUG:
+        print(f"Room members: {[token.decode('utf-8') for token in members]}")  # List current members
+        for member_token, (member_addr, _) in recipients:
+            print(f"Sending to {member_token.decode('utf-8')} at {member_addr}")  # Notify where message is sent
+
+    # Send the unchanged packet to all other members in the room
+    send_to_members(udp_sock, data, recipients, sender)
+
+def handle_udp_readable(udp_sock, receiver, sender, updates=None):
+    """Drain every queued datagram and relay each one to its room."""
+    # Drain every queued datagram with as few syscalls as possible
     try:
-        # Bind the UDP socket to all interfaces on the specified port
-        udp_sock.bind(('0.0.0.0', SERVER_UDP_PORT))  
-        print(f"UDP server listening on port {SERVER_UDP_PORT}")  # Notify that the server is listening
-        
-        while not shutdown_event.is_set():  # Loop until a shutdown event is signaled
-            udp_sock.settimeout(1.0)  # Set a timeout for receiving data
-            try:
-                # Receive messages sent to the UDP socket
-                data, addr = udp_sock.recvfrom(BUFFER_SIZE)  # Blocking call to receive data
-                
-                # Parse the received packet
-                room_name_size = data[0]  # First byte: size of the room name
-                token_size = data[1]  # Second byte: size of the sender's token
-                room_name = data[2:2 + room_name_size].decode('utf-8')  # Extract room name
-                sender_token = data[2 + room_name_size:2 + room_name_size + token_size]  # Extract sender's token
-                message = data[2 + room_name_size + token_size:].decode('utf-8')  # Extract message
-
-                print(f"\nReceived message in room {room_name}")  # Notify of the received message
-                print(f"From: {sender_token.decode('utf-8')} at {addr}")  # Display sender's token and address
-                print(f"Message: {message}")  # Display the message content
-
-                # Check if the room exists in the chat_rooms dictionary
-                if room_name in chat_rooms:
-                    members = chat_rooms[room_name]  # Get members of the chat room
-                    print(f"Room members: {[token[0].decode('utf-8') for token in members]}")  # List current members
-                    
-                    # Prepare the packet to send to all room members
-                    packet = (
-                        bytes([len(room_name)]) +  # Room name length
-                        bytes([len(sender_token)]) +  # Sender token length
-                        room_name.encode('utf-8') +  # Room name as bytes
-                        sender_token +  # Sender's token
-                        message.encode('utf-8')  # Message content as bytes
-                    )
-                    
-                    # Send the message packet to all members in the room
-                    for member_token, member_addr in members:
-                        try:
-                            print(f"Sending to {member_token.decode('utf-8')} at {member_addr}")  # Notify where message is sent
-                            udp_sock.sendto(packet, member_addr)  # Send the message packet
-                        except Exception as e:
-                            print(f"Error sending to {member_token.decode('utf-8')}: {e}")  # Handle errors during sending
-                else:
-                    print(f"Room {room_name} not found")  # Notify if room does not exist
-                    udp_sock.sendto(b"Room not found", addr)  # Send error message back to sender
-                    
-            except socket.timeout:
-                continue  # Ignore timeout and continue waiting for messages
-            except Exception as e:
-                if not shutdown_event.is_set():  # Check if shutdown is not signaled
-                    print(f"Error in UDP handler: {e}")  # Print any error encountered
-    finally:
-        udp_sock.close()  # Ensure the UDP socket is closed upon exit
+        datagrams = receiver.receive(udp_sock)
+    except BlockingIOError:
+        return  # Spurious wakeup; wait for the next readiness event
+    except Exception as e:
+        if not shutdown_event.is_set():  # Check if shutdown is not signaled
+            print(f"Error in UDP handler: {e}")  # Print any error encountered
+        return
+    if updates is not None:
+        # The pipe and the socket are separate readiness sources, so the loop may report
+        # this batch first; apply any join still queued so its sender's datagram finds the room
+        apply_member_updates(updates)
+    for data, addr in datagrams:
+        try:
+            relay_message(udp_sock, data, addr, sender)
+        except Exception as e:
+            print(f"Error relaying message from {addr}: {e}")  # Skip malformed packets
+
+def add_member(room_name, token, addr):
+    """Add a member to a room, here and in every UDP worker process."""
+    chat_rooms.setdefault(room_name, {})[token] = (addr, make_sockaddr(addr))
+    # Workers are told before the TCP reply goes out and drain these updates before relaying each
+    # received batch, so the member's first datagram is handled after the join is applied
+    for updates in member_update_pipes:
+        updates.send((room_name, token, addr))
+
+def apply_member_updates(updates):
+    """Apply membership changes sent by the control-plane process (runs in UDP workers)."""
+    while updates.poll():
+        room_name, token, addr = updates.recv()
+        chat_rooms.setdefault(room_name, {})[token] = (addr, make_sockaddr(addr))
+
+def handle_room_request(data, addr):
+    """Create or join the room described by a complete TCP request and return the reply."""
+    # Parse data from the client
+    room_name_size = data[0]      # Length of the room name (first byte)
+    operation_code = data[1]      # Operation code (1: create, 2: join; second byte)
+    state_code = data[2]          # State code (unused; third byte)
+    room_name = data[3:3 + room_name_size].decode('utf-8')  # Extract the room name
+    
+    print(f"Room: {room_name}, Operation: {operation_code}")  # Display parsed room and operation info
+    
+    if operation_code == 1:  # Create room
+        # Check if the room already exists
+        if room_name not in chat_rooms:
+            # Create the room if it doesn't exist
+            token = f"host_{addr[0]}".encode('utf-8')  # Create a token for the host
+            add_member(room_name, token, addr)  # Create the room with the host as its first member
+            print(f"Created room {room_name} with host {token.decode('utf-8')}")  # Notify room creation
+            return b"Room created " + token  # Send confirmation to the client
+        return b"Room already exists"  # Notify if room already exists
+
+    if operation_code == 2:  # Join room
+        # Check if the room exists for joining
+        if room_name in chat_rooms:
+            # Create a token for the new guest
+            token = f"guest_{addr[0]}_{len(chat_rooms[room_name])}".encode('utf-8')
+            add_member(room_name, token, addr)  # Add the new guest to the room
+            print(f"Client {token.decode('utf-8')} joined room {room_name}")  # Notify of the new member
+            print(f"Current room members: {[t.decode('utf-8') for t in chat_rooms[room_name]]}")  # List current members
+            return b"Joined room " + token  # Send confirmation with the new token
+        return b"Room not found"  # Notify if the room to join does not exist
+
+    return None  # Unknown operation; close without a reply
+
+def set_low_latency(conn):
+    """Disable Nagle and delayed ACKs on a short request/reply TCP connection."""
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, 'TCP_QUICKACK'):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)  # Linux only
 
-def handle_tcp_connection(conn, addr):
+async def handle_tcp_async(reader, writer):
     """Handle a new TCP connection and manage room creation or joining."""
+    addr = writer.get_extra_info('peername')
     print(f"New TCP connection from {addr}")  # Notify of a new TCP connection
     try:
-        data = conn.recv(BUFFER_SIZE)  # Receive data from the client
-        if not data:
-            return  # If no data is received, exit the function
-        
-        # Parse data from the client
-        room_name_size = data[0]      # Length of the room name (first byte)
-        operation_code = data[1]      # Operation code (1: create, 2: join; second byte)
-        state_code = data[2]          # State code (unused; third byte)
-        room_name = data[3:3 + room_name_size].decode('utf-8')  # Extract the room name
-        
-        print(f"Room: {room_name}, Operation: {operation_code}")  # Display parsed room and operation info
-        
-        if operation_code == 1:  # Create room
-            # Check if the room already exists
-            if room_name not in chat_rooms:
-                # Create the room if it doesn't exist
-                chat_rooms[room_name] = []  # Initialize room with an empty list of members
-                token = f"host_{addr[0]}".encode('utf-8')  # Create a token for the host
-                chat_rooms[room_name].append((token, addr))  # Add the host to the room's member list
-                print(f"Created room {room_name} with host {token.decode('utf-8')}")  # Notify room creation
-                conn.sendall(b"Room created " + token)  # Send confirmation to the client
-            else:
-                conn.sendall(b"Room already exists")  # Notify if room already exists
-
-        elif operation_code == 2:  # Join room
-            # Check if the room exists for joining
-            if room_name in chat_rooms:
-                # Create a token for the new guest
-                token = f"guest_{addr[0]}_{len(chat_rooms[room_name])}".encode('utf-8')
-                chat_rooms[room_name].append((token, addr))  # Add the new guest to the room
-                print(f"Client {token.decode('utf-8')} joined room {room_name}")  # Notify of the new member
-                print(f"Current room members: {[t[0].decode('utf-8') for t in chat_rooms[room_name]]}")  # List current members
-                conn.sendall(b"Joined room " + token)  # Send confirmation with the new token
-            else:
-                conn.sendall(b"Room not found")  # Notify if the room to join does not exist
+        set_low_latency(writer.get_extra_info('socket'))
+        header = await reader.readexactly(3)  # room_name_size, operation_code, state_code
+        room_name = await reader.readexactly(header[0])  # Room name bytes
+        response = handle_room_request(header + room_name, addr)
+        if response is not None:
+            writer.write(response)  # Send the reply to the client
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass  # Client closed before completing the request
     except Exception as e:
         print(f"Error handling TCP connection: {e}")  # Handle errors that occur during TCP handling
     finally:
-        conn.close()  # Ensure the connection is closed upon exit
+        writer.close()  # Ensure the connection is closed upon exit
 
-def cleanup_server(tcp_sock):
+def cleanup_server(tcp_sock, udp_sock):
     """Cleanup server resources on shutdown."""
     print("\nShutting down server...")  # Notify shutdown process
-    shutdown_event.set()  # Signal all threads to shut down
     tcp_sock.close()  # Close the TCP socket
+    if udp_sock is not None:
+        udp_sock.close()  # Close the UDP socket
+    for worker in udp_workers:
+        worker.terminate()  # SIGTERM: each worker stops its event loop and closes its socket
+        worker.join()
     chat_rooms.clear()  # Clear the chat rooms dictionary
     clients.clear()  # Clear the clients dictionary
     sys.exit(0)  # Exit the program
 
+def install_signal_handlers(loop):
+    """Make SIGINT/SIGTERM set the shutdown event from inside the loop, waking it immediately."""
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            signal.signal(sig, lambda s, f: sys.exit(0))  # No loop signal handlers (Windows); unwind instead
+
+def attach_udp_relay(loop, udp_sock, updates=None):
+    """Relay chat datagrams arriving on udp_sock from the loop's readiness callbacks.
+
+    updates is the membership pipe of a UDP worker; it is drained before every batch is relayed.
+    """
+    if HAS_RECVMMSG:
+        # GRO reads are only split on the recvmmsg path, so only enable GRO there
+        buffer_size = GRO_BUFFER_SIZE if enable_udp_gro(udp_sock) else BUFFER_SIZE
+        receiver = BatchReceiver(buffer_size=buffer_size)  # Batched receive on Linux
+    else:
+        receiver = SimpleReceiver()  # One datagram per syscall elsewhere
+    sender = BatchSender() if HAS_SENDMMSG else None  # Batched fanout on Linux
+
+    # The UDP socket keeps its batched recvmmsg path; the loop only reports readiness
+    loop.add_reader(udp_sock, handle_udp_readable, udp_sock, receiver, sender, updates)
+
+async def run_server(tcp_sock, udp_sock):
+    """Serve the TCP control plane, and the UDP relay unless worker processes own it."""
+    loop = asyncio.get_running_loop()
+    install_signal_handlers(loop)
+    if udp_sock is not None:
+        attach_udp_relay(loop, udp_sock)
+    server = await asyncio.start_server(handle_tcp_async, sock=tcp_sock, backlog=TCP_BACKLOG)
+    try:
+        async with server:
+            await shutdown_event.wait()  # Sleep until shutdown; no periodic wakeups
+    finally:
+        if udp_sock is not None:
+            loop.remove_reader(udp_sock)
+
+async def run_udp_worker(udp_sock, updates):
+    """Relay datagrams for one SO_REUSEPORT socket and track membership sent by the parent."""
+    loop = asyncio.get_running_loop()
+    install_signal_handlers(loop)
+    attach_udp_relay(loop, udp_sock, updates)
+    loop.add_reader(updates.fileno(), apply_member_updates, updates)
+    try:
+        await shutdown_event.wait()
+    finally:
+        loop.remove_reader(updates.fileno())
+        loop.remove_reader(udp_sock)
+
+def udp_worker_main(updates, cpu):
+    """Entry point of a UDP worker process."""
+    udp_sock = open_udp_relay_socket(cpu)
+    try:
+        asyncio.run(run_udp_worker(udp_sock, updates))
+    finally:
+        udp_sock.close()
+
+def open_udp_relay_socket(cpu=None):
+    """Create, tune and bind a non-blocking UDP relay socket."""
+    udp_sock = create_udp_socket()  # Create a UDP socket
+    enable_busy_poll(udp_sock, BUSY_POLL_USEC)  # Trade CPU for receive latency when configured
+    if cpu is not None and hasattr(socket, 'SO_INCOMING_CPU'):
+        # Have the kernel process this socket's receives on a CPU local to the NIC
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_INCOMING_CPU, cpu)
+
+    # Bind the UDP socket to all interfaces on the specified port
+    udp_sock.bind(('0.0.0.0', SERVER_UDP_PORT))
+    udp_sock.setblocking(False)  # Set once; readiness comes from the event loop
+    return udp_sock
+
+def start_udp_workers(count, cpus):
+    """Start count worker processes, each with its own SO_REUSEPORT socket on the UDP port."""
+    cpus = sorted(cpus) if cpus else []
+    for i in range(count):
+        updates, worker_updates = multiprocessing.Pipe(duplex=False)
+        cpu = cpus[i % len(cpus)] if cpus else None  # Spread workers over the NIC-local CPUs
+        worker = multiprocessing.Process(target=udp_worker_main, args=(updates, cpu), daemon=True)
+        worker.start()
+        member_update_pipes.append(worker_updates)
+        udp_workers.append(worker)
+
 def start_server():
     """Start the server with proper signal handling and cleanup."""
+    pinned_cpus = pin_to_nic_numa_node(NIC_INTERFACE)  # Before creating sockets, so they start on the node
     tcp_sock = create_tcp_socket()  # Create a TCP socket
+    udp_sock = None
     
     try:
-        # Configure the TCP socket and bind it to the specified port
+        # Bind the TCP socket to the specified port; asyncio starts listening on it
         tcp_sock.bind(('0.0.0.0', SERVER_TCP_PORT))  # Bind to all interfaces
-        tcp_sock.listen(5)  # Listen for incoming connections
+
+        if UDP_WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            # The kernel hashes each client to one worker's socket; this process keeps the control plane
+            start_udp_workers(UDP_WORKERS, pinned_cpus)
+        else:
+            udp_sock = open_udp_relay_socket(min(pinned_cpus) if pinned_cpus else None)
         print(f"Server started on TCP port {SERVER_TCP_PORT} and UDP port {SERVER_UDP_PORT}")  # Notify server status
 
-        # Set up signal handlers for graceful shutdown (e.g., on Ctrl+C)
-        signal.signal(signal.SIGINT, lambda s, f: cleanup_server(tcp_sock))
-        signal.signal(signal.SIGTERM, lambda s, f: cleanup_server(tcp_sock))
-
-        # Start the UDP handler in a separate thread
-        udp_thread = threading.Thread(target=lambda: asyncio.run(udp_chat_handler()))
-        udp_thread.start()
-
-        # Main loop for accepting TCP connections
-        while not shutdown_event.is_set():
-            try:
-                tcp_sock.settimeout(1.0)  # Set timeout for accept()
-                conn, addr = tcp_sock.accept()  # Wait for incoming connections
-                # Handle each TCP connection in a separate thread
-                client_thread = threading.Thread(target=handle_tcp_connection, args=(conn, addr))
-                client_thread.start()
-            except socket.timeout:
-                continue  # Timeout occurred, check shutdown flag
-            except Exception as e:
-                if not shutdown_event.is_set():
-                    print(f"Error accepting connection: {e}")
+        # Serve until SIGINT/SIGTERM; cleanup_server closes the sockets afterwards
+        asyncio.run(run_server(tcp_sock, udp_sock))
 
     except Exception as e:
         print(f"Server error: {e}")
     finally:
-        cleanup_server(tcp_sock)
+        cleanup_server(tcp_sock, udp_sock)
 
 if __name__ == '__main__':
     try:
@@ -8,15 +8,38 @@ const request = {
     id: 1
 };
 
+// ヘッダの長さ（ペイロード長4バイト + ペイロードの形式1バイト）
+const HEADER_SIZE = 5;
+const FORMAT_JSON = 0;
+
+// メッセージの先頭に4バイト（ビッグエンディアン）のペイロード長と形式を付ける
+function encodeFrame(obj) {
+    const payload = Buffer.from(JSON.stringify(obj));
+    const header = Buffer.alloc(HEADER_SIZE);
+    header.writeUInt32BE(payload.length, 0);
+    header.writeUInt8(FORMAT_JSON, 4);
+    return Buffer.concat([header, payload]);
+}
+
 // サーバに接続
 client.connect(65432, 'localhost', () => {
     console.log('サーバに接続しました');
-    client.write(JSON.stringify(request));
+    client.write(encodeFrame(request));
 });
 
 // サーバからのレスポンスを受信
+// レスポンスは複数のdataイベントに分かれて届くことがあるため、長さ分揃うまで溜める
+let received = Buffer.alloc(0);
 client.on('data', (data) => {
-    const response = JSON.parse(data);
+    received = Buffer.concat([received, data]);
+    if (received.length < HEADER_SIZE) {
+        return;
+    }
+    const size = received.readUInt32BE(0);
+    if (received.length < HEADER_SIZE + size) {
+        return;
+    }
+    const response = JSON.parse(received.subarray(HEADER_SIZE, HEADER_SIZE + size));
     console.log('受信したレスポンス:', response);
     client.destroy(); // 通信を終了
 });
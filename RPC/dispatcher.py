@@ -0,0 +1,45 @@
+"""RPCリクエストを処理する（デコード → 関数の呼び出し → エンコード）
+
+リクエストごとに必ず通る処理なので、server.py から分けてある。
+このままでも動作するが、Cythonがあれば次のコマンドでC拡張にコンパイルでき、
+リクエストごとの処理がインタプリタを介さずに実行される（server.py の変更は不要）。
+
+    cythonize -3 -i dispatcher.py
+"""
+import asyncio
+
+# メソッドが存在しない場合のエラーメッセージ
+METHOD_NOT_FOUND = "Method not found"
+
+
+# 引数の型注釈はCythonでコンパイルしたときに型付きの変数として扱われる
+# （dictの検索やtupleの展開がPython APIを直接呼び出す処理になる）
+async def dispatch(data, codec: tuple, functions: dict, executor_methods: frozenset):
+    """受信したリクエストを処理し、送信するレスポンスのバイト列を返す"""
+    loads, encode_result, encode_error = codec
+    # 受信したデータをデコード（バイト列のまま渡す）
+    request: dict = loads(data)
+
+    # リクエストからメソッド名、パラメータ、リクエストIDを取得
+    method = request.get("method")
+    params = request.get("params", [])  # デフォルト値として空のリストを指定
+    request_id = request.get("id")
+
+    # リクエストされたメソッドを関数マッピングから取得（1回の辞書検索で済ませる）
+    fn = functions.get(method)
+    if fn is None:
+        # メソッドが存在しない場合、エラーレスポンスを作成
+        return encode_error(METHOD_NOT_FOUND, request_id)
+    try:
+        # 対応する関数を呼び出し、結果を取得
+        if method in executor_methods:
+            # 入力サイズに比例して時間のかかるメソッドはスレッドプールで実行する
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, fn, *params)
+        else:
+            result = fn(*params)
+        # 成功したレスポンスを作成（結果の型とリクエストIDを含める）
+        return encode_result(result, type(result), request_id)
+    except Exception as e:
+        # エラーが発生した場合、エラーメッセージをレスポンスに含める
+        return encode_error(str(e), request_id)
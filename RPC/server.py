@@ -1,85 +1,469 @@
+import asyncio
+from collections import Counter
 import json
-import socket
 import math
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import struct
+from typing import Any
+
+from dispatcher import METHOD_NOT_FOUND, dispatch
+
+# orjson があれば高速なJSONエンコード/デコードを使用し、なければ標準のjsonで代用
+try:
+    import orjson
+
+    # orjson は64ビットを超える整数を浮動小数点数に変換してしまうため、
+    # 19桁以上の数字の並びを含むリクエストは標準のjsonでデコードする（値が変わらないようにする）
+    long_digits = re.compile(rb'[0-9]{19}')
+
+    def json_loads(data):
+        if long_digits.search(data):
+            return json.loads(bytes(data))
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # 64ビットを超える整数など、orjsonでエンコードできない値は標準のjsonでエンコードする
+            return json.dumps(obj).encode()
+
+    # 結果の型ごとに、型名を含むレスポンスの中間部分をエンコードしてキャッシュする
+    result_type_fragments = {}
+
+    def encode_result(result, result_type, request_id):
+        """成功レスポンスをエンコードする（固定のキー部分は毎回エンコードしない）"""
+        fragment = result_type_fragments.get(result_type)
+        if fragment is None:
+            fragment = b',"result_type":"' + result_type.__name__.encode() + b'","id":'
+            result_type_fragments[result_type] = fragment
+        return b'{"results":' + json_dumps(result) + fragment + json_dumps(request_id) + b'}'
+
+    # よく返すエラーメッセージは、メッセージ部分までエンコードしておく
+    error_fragments = {METHOD_NOT_FOUND: b'{"error":"' + METHOD_NOT_FOUND.encode() + b'","id":'}
+
+    def encode_error(message, request_id):
+        """エラーレスポンスをエンコードする（固定の部分は毎回エンコードしない）"""
+        fragment = error_fragments.get(message)
+        if fragment is None:
+            fragment = b'{"error":' + json_dumps(message) + b',"id":'
+        return fragment + json_dumps(request_id) + b'}'
+except ImportError:
+    def json_loads(data):
+        # 標準のjsonはmemoryviewを受け付けないためbytesに変換する
+        return json.loads(bytes(data))
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+    def encode_result(result, result_type, request_id):
+        """成功レスポンスをエンコードする"""
+        return json_dumps({
+            "results": result,
+            "result_type": result_type.__name__,
+            "id": request_id
+        })
+
+    def encode_error(message, request_id):
+        """エラーレスポンスをエンコードする"""
+        return json_dumps({
+            "error": message,
+            "id": request_id
+        })
+
+# msgspec か msgpack があればJSONの代わりにmsgpackでエンコードしたメッセージも受け付ける
+# （msgspec の方が高速なので、両方あれば msgspec を使う）
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-def floor_function(x):
-    """指定した数値を切り捨てて最も近い整数を返す関数"""
-    return math.floor(x)
+# NumPy があれば数値配列のソートに使用する
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Numba があれば数値計算の関数をJITコンパイルする
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# これより短い配列はNumPy配列への変換コストの方が大きいため sorted() を使う
+NUMPY_SORT_THRESHOLD = 64
+
+# NumPyでソートする要素の型と、その型の配列として正しく変換できたときのdtypeの種類
+NUMPY_DTYPE_KINDS = {int: 'iu', float: 'f'}
+
+# これより短い文字列のアナグラム判定は文字の出現回数を数えずにソートして比較する
+ANAGRAM_COUNT_THRESHOLD = 128
+
+# 文字の種類がこれ以下なら Counter を作らずに str.count で文字ごとに数える
+ANAGRAM_COUNT_MAX_DISTINCT = 32
 
 def nroot_function(n, x):
     """n乗根を計算する関数"""
-    return x ** (1/n)
+    return x ** (1.0 / n)
+
+if njit is not None:
+    nroot_function = njit(cache=True, fastmath=True)(nroot_function)
+    # 最初のリクエストでコンパイル時間がかからないように起動時に一度呼んでおく
+    # （引数の型ごとにコンパイルされるため、xが整数の場合と小数の場合の両方）
+    nroot_function(2, 2)
+    nroot_function(2, 2.0)
 
 def reverse_function(s):
     """文字列を逆にして返す関数"""
+    # ASCII文字列のスライスはC側で1バイトずつコピーするだけなので、
+    # bytesやNumPy配列へ変換してから反転するより速い（変換のコピーが増えるだけ）
     return s[::-1]
 
 def valid_anagram_function(str1, str2):
     """2つの文字列がアナグラムであるかを判定する関数"""
-    return sorted(str1) == sorted(str2)
+    # 長さが違えばアナグラムにはならない
+    if len(str1) != len(str2):
+        return False
+    # 短い文字列は出現回数を数える準備の方が高くつくため、ソートして比較する
+    if len(str1) < ANAGRAM_COUNT_THRESHOLD:
+        return sorted(str1) == sorted(str2)
+    # ASCII文字列はバイト値ごとの出現回数をNumPyで数えて比較する
+    if (np is not None and isinstance(str1, str) and isinstance(str2, str)
+            and str1.isascii() and str2.isascii()):
+        h1 = np.bincount(np.frombuffer(str1.encode(), dtype=np.uint8), minlength=128)
+        h2 = np.bincount(np.frombuffer(str2.encode(), dtype=np.uint8), minlength=128)
+        return bool(np.array_equal(h1, h2))
+    # ソートせずに文字ごとの出現回数を比較する
+    if isinstance(str1, str) and isinstance(str2, str):
+        distinct = set(str1)
+        if len(distinct) <= ANAGRAM_COUNT_MAX_DISTINCT:
+            # 文字の種類が少なければ str.count（C側の走査）で1種類ずつ数える方が速い
+            # 長さが同じなので、str1の文字の回数がすべて一致すればstr2に他の文字はない
+            return all(str1.count(c) == str2.count(c) for c in distinct)
+    return Counter(str1) == Counter(str2)
+
+def uniform_numeric_type(arr):
+    """配列の要素がすべてint、またはすべてfloatならその型を、そうでなければNoneを返す"""
+    first = type(arr[0])
+    if first in NUMPY_DTYPE_KINDS and all(type(x) is first for x in arr):
+        return first
+    return None
 
 def sort_function(strArr):
     """文字列の配列をソートして返す関数"""
+    # 要素がすべて同じ数値型の場合だけNumPy配列に変換する
+    # （intとfloatが混在するとfloat64に変換され、2**53を超える整数の大小が失われるため）
+    # JSONのオブジェクト（dict）などはキーのソートになるため、配列の場合だけ要素を調べる
+    element_type = None
+    if (np is not None and isinstance(strArr, list)
+            and len(strArr) >= NUMPY_SORT_THRESHOLD):
+        element_type = uniform_numeric_type(strArr)
+    if element_type is not None:
+        a = np.asarray(strArr)
+        # 整数・浮動小数点の1次元配列はNumPyのCレベルの比較でソートする
+        # （kind='stable' は小さい整数型では基数ソートになる）
+        # 64ビットに収まらない整数はobject型の配列になるため sorted() を使う
+        if a.ndim == 1 and a.dtype.kind in NUMPY_DTYPE_KINDS[element_type]:
+            # 並び順だけをNumPyで求め、要素は元のPythonオブジェクトを返す
+            return [strArr[i] for i in np.argsort(a, kind='stable').tolist()]
     return sorted(strArr)
 
+def floor_batch_function(xs):
+    """数値の配列をまとめて切り捨てて返す関数"""
+    # mapは組み込み関数をC側のループで呼び出す
+    return list(map(math.floor, xs))
+
+def nroot_batch_function(n, xs):
+    """数値の配列それぞれのn乗根をまとめて計算する関数"""
+    if np is not None:
+        a = np.asarray(xs, dtype=np.float64)
+        # 負の数のべき乗はPythonでは複素数になるが、float64の配列ではnanになるため、
+        # 負の数を含む場合は nroot と同じ結果になるようにPythonで計算する
+        if not (a < 0).any():
+            return np.power(a, 1.0 / n).tolist()
+    return [x ** (1.0 / n) for x in xs]
+
+def sort_batch_function(arrs):
+    """複数の配列をそれぞれソートして返す関数"""
+    # sort_function と同じく、すべての行の要素が同じ数値型の場合だけNumPy配列に変換する
+    element_type = None
+    if np is not None and arrs and all(isinstance(arr, list) and arr for arr in arrs):
+        element_type = uniform_numeric_type(arrs[0])
+        if element_type is not None and any(
+                uniform_numeric_type(arr) is not element_type for arr in arrs[1:]):
+            element_type = None
+    if element_type is not None:
+        try:
+            a = np.asarray(arrs)
+        except ValueError:
+            a = None  # 長さのそろっていない配列は2次元配列にできない
+        # 長さのそろった数値配列は1回の呼び出しで行ごとにソートする
+        if (a is not None and a.ndim == 2
+                and a.dtype.kind in NUMPY_DTYPE_KINDS[element_type]):
+            order = np.argsort(a, axis=-1, kind='stable').tolist()
+            return [[arr[i] for i in idx] for arr, idx in zip(arrs, order)]
+    return [sort_function(arr) for arr in arrs]
+
 # 関数マッピング
 # メソッド名を関数にマッピングする辞書を作成
 functions = {
-    "floor": floor_function,
+    # math.floor はC実装の組み込み関数なので、ラッパー関数を挟まずに直接呼び出す
+    "floor": math.floor,
     "nroot": nroot_function,
     "reverse": reverse_function,
     "validAnagram": valid_anagram_function,
     "sort": sort_function,
+    # 同じメソッドを何度も呼び出す代わりに、まとめて1回で処理するためのメソッド
+    "floorBatch": floor_batch_function,
+    "nrootBatch": nroot_batch_function,
+    "sortBatch": sort_batch_function,
 }
 
-# ソケットの設定
-# TCP/IPソケットを作成し、特定のアドレスとポートでバインド
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind(('localhost', 65432))  # ローカルホストのポート65432で待機
-server_socket.listen()  # 接続を待機
-
-print("サーバはポート65432で待機しています...")
-
-while True:
-    # クライアントからの接続を待ち、接続されたら受け入れる
-    conn, addr = server_socket.accept()
-    with conn:
-        print('接続された:', addr)  # 接続されたクライアントのアドレスを表示
-        data = conn.recv(1024)  # クライアントからデータを受信
-        if not data:  # データがなければループを終了
-            break
-        
-        # 受信したデータをJSONとしてデコード
-        request = json.loads(data.decode())
-        
-        # リクエストからメソッド名、パラメータ、リクエストIDを取得
-        method = request.get("method")
-        params = request.get("params", [])  # デフォルト値として空のリストを指定
-        request_id = request.get("id")
-
-        # リクエストされたメソッドが関数マッピングに存在するかを確認
-        if method in functions:
-            try:
-                # 対応する関数を呼び出し、結果を取得
-                result = functions[method](*params)
-                # 成功したレスポンスを作成
-                response = {
-                    "results": result,
-                    "result_type": type(result).__name__,  # 結果の型を取得
-                    "id": request_id  # リクエストIDを保持
-                }
-            except Exception as e:
-                # エラーが発生した場合、エラーメッセージをレスポンスに含める
-                response = {
-                    "error": str(e),
-                    "id": request_id
-                }
-        else:
-            # メソッドが存在しない場合、エラーレスポンスを作成
-            response = {
-                "error": "Method not found",
+# メッセージの先頭に付けるヘッダ
+# ペイロード長（4バイト、ビッグエンディアン）とペイロードの形式（1バイト）
+FRAME_HEADER = struct.Struct('>IB')
+
+# ペイロードの形式
+FORMAT_JSON = 0
+FORMAT_MSGPACK = 1
+
+# 形式ごとの (デコード関数, 成功レスポンスのエンコード関数, エラーレスポンスのエンコード関数)
+codecs = {FORMAT_JSON: (json_loads, encode_result, encode_error)}
+
+# 対応していない形式のリクエストに返すレスポンス（内容が固定なので起動時にエンコードしておく）
+UNSUPPORTED_FORMAT_RESPONSE = encode_error("Unsupported format", None)
+
+
+class JsonResponse(bytes):
+    """msgpackのリクエストに対してJSONで返すレスポンス
+
+    msgpackは64ビットを超える整数を表せないため、そのような結果はJSONでエンコードし、
+    フレームの形式をJSONにして返す（クライアントはフレームの形式を見てデコードする）
+    """
+
+
+def json_fallback_result(result, result_type, request_id):
+    """msgpackでエンコードできない成功レスポンスをJSONでエンコードする"""
+    return JsonResponse(encode_result(result, result_type, request_id))
+
+if msgspec is not None:
+    class RpcResult(msgspec.Struct):
+        """成功レスポンス（フィールド名がそのままキーになる）"""
+        results: Any
+        result_type: str
+        id: Any
+
+    class RpcError(msgspec.Struct):
+        """エラーレスポンス"""
+        error: str
+        id: Any
+
+    # エンコーダ/デコーダは使い回す
+    msgpack_loads = msgspec.msgpack.Decoder().decode
+    msgpack_dumps = msgspec.msgpack.Encoder().encode
+
+    def msgpack_encode_result(result, result_type, request_id):
+        """成功レスポンスをmsgpackでエンコードする"""
+        try:
+            return msgpack_dumps(RpcResult(result, result_type.__name__, request_id))
+        except OverflowError:
+            return json_fallback_result(result, result_type, request_id)
+
+    def msgpack_encode_error(message, request_id):
+        """エラーレスポンスをmsgpackでエンコードする"""
+        return msgpack_dumps(RpcError(message, request_id))
+
+    codecs[FORMAT_MSGPACK] = (msgpack_loads, msgpack_encode_result, msgpack_encode_error)
+elif msgpack is not None:
+    def msgpack_loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+    def msgpack_dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def msgpack_encode_result(result, result_type, request_id):
+        """成功レスポンスをmsgpackでエンコードする"""
+        try:
+            return msgpack_dumps({
+                "results": result,
+                "result_type": result_type.__name__,
                 "id": request_id
-            }
+            })
+        except OverflowError:
+            return json_fallback_result(result, result_type, request_id)
+
+    def msgpack_encode_error(message, request_id):
+        """エラーレスポンスをmsgpackでエンコードする"""
+        return msgpack_dumps({
+            "error": message,
+            "id": request_id
+        })
+
+    codecs[FORMAT_MSGPACK] = (msgpack_loads, msgpack_encode_result, msgpack_encode_error)
+
+# 起動するワーカープロセスの数（SO_REUSEPORTで同じポートを共有し、カーネルが接続を振り分ける）
+RPC_WORKERS = int(os.environ.get('RPC_WORKERS', os.cpu_count() or 1))
+
+# 接続ごとのカーネルの送受信バッファサイズ
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# 接続ごとに確保する受信バッファのサイズ（これより大きいメッセージが来たら拡張する）
+RECV_BUFFER_SIZE = 65536
+
+# 1つのメッセージとして受け付ける最大のペイロード長
+# （不正な長さが送られてきても、その長さ分のバッファを確保しないようにする）
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# 計算量が入力サイズに比例して大きくなるメソッド
+# イベントループを止めないようにスレッドプールで実行する
+EXECUTOR_METHODS = frozenset({"sort", "validAnagram", "floorBatch", "nrootBatch", "sortBatch"})
+
+
+async def handle_client(loop, conn, addr):
+    """クライアント1件ごとにリクエストを受信してレスポンスを返すコルーチン"""
+    print('接続された:', addr)  # 接続されたクライアントのアドレスを表示
+    # 小さなレスポンスがNagleアルゴリズムで遅延しないようにする
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # 接続を使い回すため、応答のないまま切れた相手を検出できるようにする
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # リクエストごとにbytesを作らないよう、接続ごとに1つのバッファを使い回す
+    # buf[start:end] が受信済みでまだ処理していないデータ
+    buf = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buf)
+    start = end = 0
+    try:
+        # クライアントが接続を閉じるまで同じ接続でリクエストを処理し続ける
+        while True:
+            # バッファに揃っているリクエストをすべて処理し、レスポンスはまとめて1回で送信する
+            # （ヘッダとペイロードを別々に受信せず、続けて届いたリクエストも1回のrecvで受け取る）
+            responses = []
+            while end - start >= FRAME_HEADER.size:
+                size, fmt = FRAME_HEADER.unpack_from(buf, start)
+                frame_end = start + FRAME_HEADER.size + size
+                if frame_end > end:
+                    break
+                codec = codecs.get(fmt)
+                if codec is None:
+                    # 対応していない形式のリクエストにはJSONでエラーを返す
+                    fmt = FORMAT_JSON
+                    payload = UNSUPPORTED_FORMAT_RESPONSE
+                else:
+                    payload = await dispatch(view[start + FRAME_HEADER.size:frame_end], codec,
+                                             functions, EXECUTOR_METHODS)
+                    if type(payload) is JsonResponse:
+                        fmt = FORMAT_JSON
+                # レスポンスはリクエストと同じ形式で返す
+                responses.append(FRAME_HEADER.pack(len(payload), fmt))
+                responses.append(payload)
+                start = frame_end
+            if responses:
+                # レスポンスをクライアントに送信
+                await loop.sock_sendall(conn, b''.join(responses))
+
+            if start == end:
+                start = end = 0
+            else:
+                # 次のリクエストがバッファの末尾に収まらなければ先頭に詰める（足りなければ拡張する）
+                if end - start >= FRAME_HEADER.size:
+                    size = FRAME_HEADER.unpack_from(buf, start)[0]
+                    if size > MAX_FRAME_SIZE:
+                        # メッセージの区切りが分からなくなるため、接続を閉じる
+                        print('メッセージが大きすぎます:', addr, size)
+                        break
+                    needed = FRAME_HEADER.size + size
+                else:
+                    needed = FRAME_HEADER.size
+                if start + needed > len(buf):
+                    if needed > len(buf):
+                        new_buf = bytearray(needed)
+                        new_buf[:end - start] = view[start:end]
+                        buf = new_buf
+                        view = memoryview(buf)
+                    else:
+                        view[:end - start] = view[start:end]  # memoryviewの代入は重なりを考慮してコピーする
+                    start, end = 0, end - start
+
+            n = await loop.sock_recv_into(conn, view[end:])  # クライアントからデータを受信
+            if n == 0:  # 接続が閉じられたらループを終了
+                break
+            end += n
+    except ConnectionError:
+        # 通信の途中で切断された場合は何もしない
+        pass
+    finally:
+        conn.close()
+
+
+def create_server_socket(reuse_port):
+    """待ち受け用のソケットを作成する"""
+    # TCP/IPソケットを作成し、特定のアドレスとポートでバインド
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # 複数のプロセスが同じポートで待ち受けられるようにする
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # 受け入れた接続はこのバッファサイズを引き継ぐ
+    # （受信バッファはウィンドウスケールがハンドシェイクで決まるため、listen前に設定する）
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    server_socket.bind(('localhost', 65432))  # ローカルホストのポート65432で待機
+    server_socket.listen()  # 接続を待機
+    server_socket.setblocking(False)
+    return server_socket
+
+
+async def main(server_socket):
+    loop = asyncio.get_running_loop()
+
+    # 処理中の接続タスク（ガベージコレクションで消えないように参照を保持）
+    tasks = set()
+    while True:
+        # クライアントからの接続を待ち、接続されたら並行して処理する
+        conn, addr = await loop.sock_accept(server_socket)
+        task = loop.create_task(handle_client(loop, conn, addr))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+def serve(reuse_port=False):
+    """1つのプロセスでイベントループを動かしてリクエストを処理する"""
+    server_socket = create_server_socket(reuse_port)
+    try:
+        asyncio.run(main(server_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_socket.close()
+
 
-        # レスポンスをクライアントに送信
-        conn.sendall(json.dumps(response).encode())
+if __name__ == "__main__":
+    if RPC_WORKERS > 1 and hasattr(socket, 'SO_REUSEPORT'):
+        # CPUを使う処理がGILで1コアに制限されないよう、ワーカープロセスを複数起動する
+        workers = [multiprocessing.Process(target=serve, args=(True,), daemon=True)
+                   for _ in range(RPC_WORKERS)]
+        for worker in workers:
+            worker.start()
+        print(f"サーバはポート65432で待機しています...（ワーカー数: {RPC_WORKERS}）")
+        # SIGTERMでもCtrl+Cと同様にワーカーを終了させてから終わる
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in workers:
+                worker.terminate()
+    else:
+        print("サーバはポート65432で待機しています...")
+        serve()
@@ -54,13 +54,13 @@ try:
         # ファイル名の送信
         sock.send(filename_bits)
 
-        # 一度に4096バイト（4096ビット）ずつ読み出し、送信することにより、ファイルを送信します。
-        # Readは読み込んだビットを返します
-        data = f.read(4096)
-        while data:
-            print("Sending...")
-            sock.send(data)
-            data = f.read(4096)
+        # sendfile()でファイルの中身を送信します。
+        # Linuxではsendfile(2)システムコールによりカーネル内でディスクからソケットへ直接転送され、
+        # ユーザー空間へのコピーが発生しません（未対応の環境では内部でsend()のループになります）
+        # 空のファイルは送る中身がなく、sendfile()は送信バイト数0を受け付けないため呼び出しません
+        print("Sending...")
+        if filesize:
+            sock.sendfile(f, 0, filesize)
 
 finally:
     print('closing socket')
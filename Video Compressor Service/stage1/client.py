@@ -2,32 +2,31 @@
 import socket
 import os
 import sys
+import zlib
 import logging
 from logging.handlers import RotatingFileHandler
 from typing import Optional
 
+def get_logger() -> logging.Logger:
+    """Return the client logger, attaching its file handler only the first time"""
+    logger = logging.getLogger('VideoUploadClient')
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        handler = RotatingFileHandler('client.log', maxBytes=1024*1024, backupCount=5)
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
 class VideoUploadClient:
     def __init__(self, host='localhost', port=9999):
         self.host = host
         self.port = port
         self.packet_size = 1400
         self.io_buffer_size = self.packet_size * 1000
+        self.sendfile_chunk_size = 16 * 1024**2  # Bytes handed to sendfile per progress update
         self.max_file_size = 4 * 1024**3  # 4GB limit
-        self.setup_logging()
-
-    def setup_logging(self):
-        """Set up logging configuration"""
-        self.logger = logging.getLogger('VideoUploadClient')
-        self.logger.setLevel(logging.INFO)
-        
-        # ログファイルが既に存在する場合は既存のハンドラを削除
-        for handler in self.logger.handlers[:]:
-            self.logger.removeHandler(handler)
-            
-        handler = RotatingFileHandler('client.log', maxBytes=1024*1024, backupCount=5)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.logger = get_logger()
 
     def validate_file(self, filepath: str) -> int:
         """
@@ -59,7 +58,7 @@ class VideoUploadClient:
 
     def calculate_checksum(self, data: bytes) -> int:
         """
-        Simple checksum calculation for data verification
+        CRC32 checksum calculation for data verification
         
         Args:
             data: Bytes to calculate checksum for
@@ -67,7 +66,7 @@ class VideoUploadClient:
         Returns:
             int: Calculated checksum
         """
-        return sum(data) & 0xFFFFFFFF
+        return zlib.crc32(data)
 
     def _handle_server_response(self, response: str) -> None:
         """
@@ -113,23 +112,24 @@ class VideoUploadClient:
 
             # Set socket buffer size for optimal performance
             client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.io_buffer_size)
+            # Don't let Nagle's algorithm hold back the file size header or the last chunk
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             # Send file size (exactly 32 bytes)
             size_message = str(file_size).ljust(32).encode()
-            client_socket.send(size_message)
+            client_socket.sendall(size_message)
 
-            # Send file data
+            # Send file data straight from the page cache with sendfile(2);
+            # it is sent in slices only so that progress can be reported
             sent = 0
             with open(filepath, 'rb') as f:
                 while sent < file_size:
-                    chunk = f.read(self.packet_size)
-                    if not chunk:
+                    count = min(self.sendfile_chunk_size, file_size - sent)
+                    n = client_socket.sendfile(f, offset=sent, count=count)
+                    if n == 0:
                         break
-                        
-                    checksum = self.calculate_checksum(chunk)
-                    client_socket.send(chunk)
-                    sent += len(chunk)
-                    
+                    sent += n
+
                     # Progress indication
                     progress = (sent / file_size) * 100
                     print(f"\rUploading: {progress:.1f}% ({sent}/{file_size} bytes)", end='', flush=True)
@@ -1,7 +1,6 @@
 #performance_check.py
 import os
 import time
-from datetime import datetime
 import logging
 from typing import Tuple, Optional, Dict
 import argparse
@@ -40,18 +39,20 @@ class FilesystemPerformanceChecker:
         )
         
         # ファイル生成
-        chunk_size = 1024 * 1024  # 1MB
         with open(test_file, 'wb') as f:
             # MP4ヘッダーを書き込む
             f.write(mp4_header)
+            f.flush()
             
-            # 残りのデータを書き込む（ビデオストリームを模倣）
-            remaining_size = (size_mb * 1024 * 1024) - len(mp4_header)
-            while remaining_size > 0:
-                write_size = min(chunk_size, remaining_size)
-                video_like_data = os.urandom(write_size)
-                f.write(video_like_data)
-                remaining_size -= write_size
+            # 残りの領域を確保する（乱数を生成して書き込むとRNGの速度がボトルネックになるため）
+            # size_mb=0 ではヘッダーだけのファイルにする（確保する長さが負にならないようにする）
+            total_size = size_mb * 1024 * 1024
+            remaining = max(0, total_size - len(mp4_header))
+            if remaining > 0:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), len(mp4_header), remaining)
+                else:
+                    f.truncate(total_size)
         
         return test_file
 
@@ -93,18 +94,24 @@ class FilesystemPerformanceChecker:
             Tuple[Dict[str, float], bool]: (パフォーマンス統計, パフォーマンス要件を満たしているか)
         """
         test_file = os.path.join(self.upload_dir, 'perftest.mp4')
-        test_data = b'x' * self.packet_size
+        # サーバーは受信データをバッファ単位で書き込むため、1秒分のパケットを
+        # パケット毎のwrite()ではなく1回の書き込みで計測する
+        test_data = b'x' * (self.packet_size * self.target_packets_per_sec)
         
         try:
-            start_time = datetime.now()
+            start_time = time.perf_counter()  # 単調増加する高分解能クロック
             
-            with open(test_file, 'wb', buffering=self.buffer_size) as f:
-                for _ in range(self.target_packets_per_sec):
-                    f.write(test_data)
-                f.flush()
-                os.fsync(f.fileno())
+            fd = os.open(test_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                view = memoryview(test_data)
+                while view:
+                    view = view[os.write(fd, view):]  # 書き込みが途中で終わった場合のみ再試行
+                # fdatasync はタイムスタンプ等のメタデータを書き出さない分 fsync より軽い（無い環境では fsync）
+                getattr(os, 'fdatasync', os.fsync)(fd)
+            finally:
+                os.close(fd)
             
-            elapsed = (datetime.now() - start_time).total_seconds()
+            elapsed = time.perf_counter() - start_time
             packets_per_second = self.target_packets_per_sec / elapsed
             
             stats = self.calculate_transfer_stats(packets_per_second)
@@ -2,10 +2,11 @@
 
 import os
 import time
+import asyncio
 import logging
 import socket
 import argparse
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple
 from common.logging_config import LogConfig
 from common.mmp_protocol import MMPProtocol
 
@@ -24,17 +25,56 @@ class VideoProcessingClient:
         self.port = port
         self.protocol = MMPProtocol()
         self.logger = LogConfig.get_component_logger("VideoClient")
+        self._pool: List[socket.socket] = []  # Idle connections to host:port
+        self._capabilities: Optional[List[str]] = None  # Actions the server supports, once probed
 
     def _connect(self) -> socket.socket:
         """Create connection to server"""
         try:
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             client_socket.connect((self.host, self.port))
+            # Small requests go out immediately instead of waiting on Nagle's algorithm
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Detect a server that disappeared while the connection sat in the pool
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
             return client_socket
         except Exception as e:
             self.logger.error(f"Connection error: {e}")
             raise
 
+    def _acquire(self) -> socket.socket:
+        """Get a pooled connection that is still open, or create a new one"""
+        while self._pool:
+            client_socket = self._pool.pop()
+            try:
+                # A closed peer reads as EOF; a live idle connection has nothing to read.
+                # Peek in non-blocking mode rather than with MSG_DONTWAIT, which Windows lacks
+                client_socket.setblocking(False)
+                try:
+                    client_socket.recv(1, socket.MSG_PEEK)
+                finally:
+                    client_socket.settimeout(None)
+            except BlockingIOError:
+                return client_socket
+            except OSError:
+                pass  # Reset or otherwise broken; the connection is dead
+            # EOF, unexpected data left from an earlier exchange, or a dead connection
+            client_socket.close()
+        return self._connect()
+
+    def _release(self, client_socket: socket.socket):
+        """Return a connection whose request/response exchange completed to the pool"""
+        self._pool.append(client_socket)
+
+    def close(self):
+        """Close all pooled connections"""
+        while self._pool:
+            self._pool.pop().close()
+
     def upload_and_process(self, filepath: str, task_type: str, 
                           parameters: Optional[Dict[str, Any]] = None) -> Optional[str]:
         """
@@ -59,15 +99,11 @@ class VideoProcessingClient:
                 'parameters': parameters or {}
             }
             
-            # Read file
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-                
             # Get media type
             media_type = os.path.splitext(filepath)[1][1:]
             
             # Connect and send request
-            client_socket = self._connect()
+            client_socket = self._acquire()
             
             try:
                 # Send request
@@ -75,12 +111,17 @@ class VideoProcessingClient:
                     client_socket,
                     json_data=request,
                     media_type=media_type,
-                    payload=file_data
+                    payload_path=filepath  # Streamed from disk, not read into memory
                 )
                 
                 # Get response
                 response, _, _ = self.protocol.receive_message(client_socket)
                 
+                if response:
+                    # The server answered, so the connection can carry the next request
+                    self._release(client_socket)
+                    client_socket = None
+                
                 if response and response.get('status') == 'accepted':
                     self.logger.info(f"Upload successful. Task ID: {response['task_id']}")
                     return response['task_id']
@@ -90,7 +131,8 @@ class VideoProcessingClient:
                     return None
                     
             finally:
-                client_socket.close()
+                if client_socket:
+                    client_socket.close()
                 
         except Exception as e:
             self.logger.error(f"Error in upload_and_process: {e}")
@@ -107,31 +149,112 @@ class VideoProcessingClient:
             Dict containing task status
         """
         try:
-            client_socket = self._connect()
-            
-            try:
-                # Send status request
-                request = {
-                    'action': 'status',
-                    'task_id': task_id
-                }
-                self.protocol.send_message(client_socket, json_data=request)
-                
-                # Get response
-                response, _, _ = self.protocol.receive_message(client_socket)
-                
-                if not response:
-                    raise RuntimeError("No response from server")
-                    
-                return response
-                
-            finally:
-                client_socket.close()
+            # Send status request
+            request = {
+                'action': 'status',
+                'task_id': task_id
+            }
+            return self._request(request)
                 
         except Exception as e:
             self.logger.error(f"Error checking status: {e}")
             raise
 
+    def check_statuses(self, task_ids: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Check status of several processing tasks with one request
+        
+        Args:
+            task_ids: Task identifiers
+            
+        Returns:
+            Dict mapping each task ID to its status (None if the server doesn't know it)
+        """
+        if 'batch_status' not in self.get_capabilities():
+            # Older server: one status request per task, still over the pooled connection
+            statuses = {}
+            for task_id in task_ids:
+                status = self.check_status(task_id)
+                statuses[task_id] = status if 'status' in status else None
+            return statuses
+
+        try:
+            response = self._request({'action': 'batch_status', 'task_ids': list(task_ids)})
+            if 'statuses' not in response:
+                raise RuntimeError(response.get('error', 'Invalid response'))
+            return response['statuses']
+            
+        except Exception as e:
+            self.logger.error(f"Error checking statuses: {e}")
+            raise
+
+    def get_capabilities(self) -> List[str]:
+        """
+        Get the actions supported by the server
+        
+        Returns:
+            List[str]: Supported actions (empty if the server predates the
+            'capabilities' action, in which case only polling is used)
+        """
+        if self._capabilities is None:
+            response = self._request({'action': 'capabilities'})
+            self._capabilities = response.get('capabilities', [])
+        return self._capabilities
+
+    def wait_for_task(self, task_id: str, max_wait_time: float) -> Dict[str, Any]:
+        """
+        Wait for a task to finish using one 'subscribe' request
+        
+        The server replies once the task has completed or failed, so the result
+        is seen as soon as it is ready instead of at the next status poll.
+        
+        Args:
+            task_id: Task identifier
+            max_wait_time: Maximum wait time in seconds
+            
+        Returns:
+            Dict containing task status (still 'queued'/'processing' on timeout)
+        """
+        request = {'action': 'subscribe', 'task_id': task_id, 'timeout': max_wait_time}
+        # Allow the server a little longer than its own timeout to reply
+        return self._request(request, timeout=max_wait_time + 30)
+
+    def _request(self, request: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Send a JSON-only request over a pooled connection and return the JSON response"""
+        client_socket = self._acquire()
+        try:
+            client_socket.settimeout(timeout)
+            self.protocol.send_message(client_socket, json_data=request)
+            # JSON-only replies fit in one read; the server sends nothing else until the next request
+            response, _, _ = self.protocol.receive_small_message(client_socket)
+            
+            if not response:
+                raise RuntimeError("No response from server")
+            
+            client_socket.settimeout(None)
+            self._release(client_socket)
+            client_socket = None
+            return response
+            
+        finally:
+            if client_socket:
+                client_socket.close()
+
+    def _poll_status(self, task_id: str, check_interval: int, max_wait_time: int) -> Optional[Dict[str, Any]]:
+        """Poll the task status until it has completed or failed; None if max_wait_time is exceeded"""
+        start_time = time.time()
+        while True:
+            if time.time() - start_time > max_wait_time:
+                return None
+                
+            status = self.check_status(task_id)
+            print(f"Status: {status['status']}")
+            
+            if status['status'] in ('completed', 'failed'):
+                return status
+                
+            time.sleep(check_interval)
+
     def download_result(self, task_id: str, output_path: str) -> bool:
         """
         Download processed file
@@ -144,7 +267,7 @@ class VideoProcessingClient:
             bool: Success status
         """
         try:
-            client_socket = self._connect()
+            client_socket = self._acquire()
             
             try:
                 # Send download request
@@ -157,6 +280,10 @@ class VideoProcessingClient:
                 # Get response
                 json_data, media_type, payload = self.protocol.receive_message(client_socket)
                 
+                if payload or json_data:
+                    self._release(client_socket)
+                    client_socket = None
+                
                 if not payload:
                     if json_data and 'error' in json_data:
                         self.logger.error(f"Server returned an error: {json_data['error']}")
@@ -176,7 +303,8 @@ class VideoProcessingClient:
                 return True
                 
             finally:
-                client_socket.close()
+                if client_socket:
+                    client_socket.close()
                 
         except Exception as e:
             self.logger.error(f"Error downloading result: {e}")
@@ -214,24 +342,24 @@ class VideoProcessingClient:
                 base, ext = os.path.splitext(filepath)
                 output_path = f"{base}_processed{ext}"
                 
-            # Wait for processing to complete
-            start_time = time.time()
-            while True:
-                if time.time() - start_time > max_wait_time:
-                    print("Maximum wait time exceeded")
-                    return False
-                    
-                status = self.check_status(task_id)
+            # Wait for processing to complete: let the server notify us when it
+            # can, otherwise fall back to polling every check_interval seconds
+            if 'subscribe' in self.get_capabilities():
+                print("Waiting for processing to complete...")
+                status = self.wait_for_task(task_id, max_wait_time)
                 print(f"Status: {status['status']}")
+                if status['status'] not in ('completed', 'failed'):
+                    status = None
+            else:
+                status = self._poll_status(task_id, check_interval, max_wait_time)
                 
-                if status['status'] == 'completed':
-                    break
-                elif status['status'] == 'failed':
-                    error_msg = status.get('error', 'Unknown error')
-                    print(f"Processing failed: {error_msg}")
-                    return False
-                    
-                time.sleep(check_interval)
+            if status is None:
+                print("Maximum wait time exceeded")
+                return False
+            elif status['status'] == 'failed':
+                error_msg = status.get('error', 'Unknown error')
+                print(f"Processing failed: {error_msg}")
+                return False
                 
             # Download result
             print("Processing completed. Downloading result...")
@@ -241,6 +369,124 @@ class VideoProcessingClient:
             print(f"Error: {e}")
             return False
 
+    async def process_and_wait_async(self, filepath: str, task_type: str,
+                                     parameters: Optional[Dict[str, Any]] = None,
+                                     output_path: Optional[str] = None,
+                                     check_interval: int = 60,
+                                     max_wait_time: int = 3600) -> bool:
+        """
+        Asynchronous version of process_and_wait
+        
+        Runs on the caller's event loop over one connection, so several uploads can
+        be awaited together with asyncio.gather() instead of one blocking thread each.
+        Note that the server accepts one active task per client IP.
+        
+        Args:
+            filepath: Input file path
+            task_type: Type of processing
+            parameters: Processing parameters
+            output_path: Output file path
+            check_interval: Status check interval in seconds (servers without subscribe)
+            max_wait_time: Maximum wait time in seconds
+            
+        Returns:
+            bool: Success status
+        """
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"File not found: {filepath}")
+
+        loop = asyncio.get_running_loop()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        async def request(json_data: Dict[str, Any], **message) -> Tuple[Optional[Dict], Optional[str], Optional[bytes]]:
+            await self.protocol.send_message_async(writer, json_data=json_data, **message)
+            return await self.protocol.receive_message_async(reader)
+
+        try:
+            # Upload and start processing
+            request_data = {
+                'action': 'upload',
+                'type': task_type,
+                'parameters': parameters or {}
+            }
+            response, _, _ = await request(
+                request_data,
+                media_type=os.path.splitext(filepath)[1][1:],
+                payload_path=filepath
+            )
+            if not response or response.get('status') != 'accepted':
+                error_msg = response.get('error', 'Unknown error') if response else 'No response'
+                self.logger.error(f"Upload failed: {error_msg}")
+                return False
+                
+            task_id = response['task_id']
+            print(f"Processing started. Task ID: {task_id}")
+            
+            # Generate default output path if not provided
+            if not output_path:
+                base, ext = os.path.splitext(filepath)
+                output_path = f"{base}_processed{ext}"
+                
+            # Wait for processing to complete
+            capabilities, _, _ = await request({'action': 'capabilities'})
+            if capabilities and 'subscribe' in capabilities.get('capabilities', []):
+                status, _, _ = await asyncio.wait_for(
+                    request({'action': 'subscribe', 'task_id': task_id, 'timeout': max_wait_time}),
+                    max_wait_time + 30
+                )
+            else:
+                deadline = loop.time() + max_wait_time
+                while True:
+                    status, _, _ = await request({'action': 'status', 'task_id': task_id})
+                    if (not status or status.get('status') in ('completed', 'failed')
+                            or loop.time() > deadline):
+                        break
+                    print(f"Status: {status.get('status')}")
+                    await asyncio.sleep(check_interval)
+                    
+            if not status or 'status' not in status:
+                raise RuntimeError(status.get('error', 'Invalid response') if status else "No response from server")
+            print(f"Status: {status['status']}")
+            
+            if status['status'] == 'failed':
+                error_msg = status.get('error', 'Unknown error')
+                print(f"Processing failed: {error_msg}")
+                return False
+            elif status['status'] != 'completed':
+                print("Maximum wait time exceeded")
+                return False
+                
+            # Download result
+            print("Processing completed. Downloading result...")
+            json_data, media_type, payload = await request({'action': 'download', 'task_id': task_id})
+            if not payload:
+                if json_data and 'error' in json_data:
+                    raise RuntimeError(json_data['error'])
+                raise RuntimeError("No data received")
+                
+            # Update output path with correct extension if needed
+            if media_type:
+                base, _ = os.path.splitext(output_path)
+                output_path = f"{base}.{media_type}"
+                
+            # Save file without blocking the event loop
+            def save():
+                with open(output_path, 'wb') as f:
+                    f.write(payload)
+            await loop.run_in_executor(None, save)
+            
+            self.logger.info(f"File downloaded successfully to {output_path}")
+            return True
+            
+        except Exception as e:
+            print(f"Error: {e}")
+            return False
+            
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
 def main():
     """
     Video Processing Client Command Line Interface
@@ -387,6 +633,8 @@ def main():
         args.max_wait_time
     )
     
+    client.close()
+    
     if success:
         print("\nProcessing completed successfully!")
     else:
@@ -2,9 +2,18 @@
 
 import os
 import logging
+import threading
 from logging.handlers import RotatingFileHandler
 from typing import Optional
 
+# DEFAULT_FORMATはスレッド・プロセス情報を使わないため、レコード毎の取得を省略
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# 複数のスレッドが同じロガーを同時に初めてセットアップしてもハンドラが重複しないようにする
+_setup_lock = threading.Lock()
+
 class LogConfig:
     """統一的なロギング設定"""
     
@@ -31,35 +40,41 @@ class LogConfig:
         Returns:
             設定済みのロガー
         """
-        # ログディレクトリの作成
-        os.makedirs(log_dir, exist_ok=True)
-
         # ロガーの取得
         logger = logging.getLogger(name)
         logger.setLevel(level)
 
-        # 既存のハンドラをクリア
-        if logger.hasHandlers():
-            logger.handlers.clear()
+        # 設定済みならハンドラを作り直さずにそのまま返す
+        if logger.handlers:
+            return logger
+
+        with _setup_lock:
+            # ロックを待つ間に別のスレッドが設定した場合はそのまま返す
+            if logger.handlers:
+                return logger
+
+            # ログディレクトリの作成
+            os.makedirs(log_dir, exist_ok=True)
 
-        # ファイル名の設定
-        if log_file is None:
-            log_file = f"{name}.log"
-        log_path = os.path.join(log_dir, log_file)
+            # ファイル名の設定
+            if log_file is None:
+                log_file = f"{name}.log"
+            log_path = os.path.join(log_dir, log_file)
 
-        # ハンドラの設定
-        handler = RotatingFileHandler(
-            log_path,
-            maxBytes=cls.MAX_BYTES,
-            backupCount=cls.BACKUP_COUNT
-        )
-        handler.setFormatter(logging.Formatter(cls.DEFAULT_FORMAT))
-        logger.addHandler(handler)
+            # ハンドラの設定
+            handler = RotatingFileHandler(
+                log_path,
+                maxBytes=cls.MAX_BYTES,
+                backupCount=cls.BACKUP_COUNT,
+                delay=True  # 最初の出力までファイルを開かない
+            )
+            handler.setFormatter(logging.Formatter(cls.DEFAULT_FORMAT))
+            logger.addHandler(handler)
 
-        # コンソール出力用ハンドラ
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(logging.Formatter(cls.DEFAULT_FORMAT))
-        logger.addHandler(console_handler)
+            # コンソール出力用ハンドラ
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(logging.Formatter(cls.DEFAULT_FORMAT))
+            logger.addHandler(console_handler)
 
         return logger
 
@@ -1,9 +1,28 @@
 # mmp_protocol.py
-import json
+import os
+import asyncio
+import socket
 import struct
-from typing import Tuple, Dict, Any, Optional
+import threading
+import time
+from typing import Tuple, Dict, Any, List, Optional, BinaryIO
 from .logging_config import LogConfig
 
+# Use orjson for the JSON part of each message when installed, otherwise the standard json
+try:
+    import orjson
+
+    json_dumps = orjson.dumps  # Returns bytes directly
+    json_loads = orjson.loads  # Accepts bytes, bytearray and memoryview
+except ImportError:
+    import json
+
+    def json_dumps(data) -> bytes:
+        return json.dumps(data).encode()
+
+    def json_loads(data):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
 class MMPProtocol:
     """Multiple Media Protocol (MMP) implementation"""
     
@@ -17,6 +36,13 @@ class MMPProtocol:
     MAX_MEDIA_TYPE_SIZE = 255  # 1 byte
     MAX_PAYLOAD_SIZE = 1099511627776  # 5 bytes = 1TB
     
+    RECV_CHUNK_SIZE = 1024 * 1024  # Upper bound for a single recv_into call
+    SMALL_MESSAGE_SIZE = 4096  # First read size in receive_small_message
+    
+    # The three header fields packed into one big-endian 64-bit integer
+    _HEADER_STRUCT = struct.Struct('>Q')
+    _PAYLOAD_SIZE_MASK = (1 << 40) - 1
+    
     def __init__(self):
         """Initialize protocol handler with logging"""
         self.logger = LogConfig.get_component_logger("MMPProtocol")
@@ -48,18 +74,9 @@ class MMPProtocol:
 
         # Pack sizes into header following protocol specification
         # Format: 2 bytes JSON size + 1 byte media type size + 5 bytes payload size
-        header = bytearray(MMPProtocol.HEADER_SIZE)
-        
-        # Pack JSON size (2 bytes)
-        header[0:2] = json_size.to_bytes(2, byteorder='big')
-        
-        # Pack media type size (1 byte)
-        header[2] = media_type_size
-        
-        # Pack payload size (5 bytes)
-        header[3:8] = payload_size.to_bytes(5, byteorder='big')
-        
-        return bytes(header)
+        return MMPProtocol._HEADER_STRUCT.pack(
+            (json_size << 48) | (media_type_size << 40) | payload_size
+        )
 
     @staticmethod
     def parse_header(header: bytes) -> Tuple[int, int, int]:
@@ -78,9 +95,10 @@ class MMPProtocol:
         if len(header) != MMPProtocol.HEADER_SIZE:
             raise ValueError(f"Invalid header size: {len(header)} bytes")
 
-        json_size = int.from_bytes(header[0:2], byteorder='big')
-        media_type_size = header[2]
-        payload_size = int.from_bytes(header[3:8], byteorder='big')
+        (fields,) = MMPProtocol._HEADER_STRUCT.unpack(header)
+        json_size = fields >> 48
+        media_type_size = (fields >> 40) & 0xFF
+        payload_size = fields & MMPProtocol._PAYLOAD_SIZE_MASK
 
         return json_size, media_type_size, payload_size
 
@@ -106,7 +124,8 @@ class MMPProtocol:
         }
 
     def send_message(self, sock, json_data: Optional[Dict] = None, 
-                    media_type: Optional[str] = None, payload: Optional[bytes] = None) -> bool:
+                    media_type: Optional[str] = None, payload: Optional[bytes] = None,
+                    payload_path: Optional[str] = None, drop_cache: bool = False) -> bool:
         """
         Send a message following the MMP protocol
         
@@ -115,13 +134,19 @@ class MMPProtocol:
             json_data: Optional JSON data to send
             media_type: Optional media type string
             payload: Optional payload bytes
+            payload_path: Optional file to send as the payload instead of payload;
+                it is streamed with sendfile rather than read into memory
+            drop_cache: Advise the kernel to evict payload_path from the page cache
+                once sent, for files that won't be read again
             
         Returns:
             bool: True if send was successful
         """
+        payload_file = None
+        corked = False
         try:
             # Convert JSON to bytes if provided
-            json_bytes = json.dumps(json_data).encode() if json_data else b''
+            json_bytes = json_dumps(json_data) if json_data else b''
             json_size = len(json_bytes)
 
             # Get media type bytes if provided
@@ -129,31 +154,107 @@ class MMPProtocol:
             media_type_size = len(media_type_bytes)
 
             # Get payload size
-            payload_size = len(payload) if payload else 0
+            if payload_path:
+                payload_file = open(payload_path, 'rb')
+                payload_size = os.fstat(payload_file.fileno()).st_size
+                if hasattr(os, 'posix_fadvise'):
+                    # The whole file is read front to back; let readahead run ahead of sendfile
+                    os.posix_fadvise(payload_file.fileno(), 0, payload_size, os.POSIX_FADV_SEQUENTIAL)
+            else:
+                payload_size = len(payload) if payload else 0
 
-            # Create and send header
+            # Create header
             header = self.create_header(json_size, media_type_size, payload_size)
-            sock.sendall(header)
 
-            # Send JSON if present
-            if json_size > 0:
-                sock.sendall(json_bytes)
+            # With a file payload the metadata and file data go out in separate calls;
+            # cork the socket so the small metadata shares full segments with the file data
+            if payload_file and hasattr(socket, 'TCP_CORK'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+                corked = True
 
-            # Send media type if present
+            # Send header, JSON, media type and an in-memory payload in one gathered write
+            buffers = [header]
+            if json_size > 0:
+                buffers.append(json_bytes)
             if media_type_size > 0:
-                sock.sendall(media_type_bytes)
+                buffers.append(media_type_bytes)
+            if payload_size > 0 and not payload_file:
+                buffers.append(payload)
+            self._sendmsg_all(sock, buffers)
 
-            # Send payload if present
-            if payload_size > 0:
-                sock.sendall(payload)
+            # Send a file payload after the metadata (sendfile rejects a zero count)
+            if payload_file and payload_size > 0:
+                # Zero-copy from the page cache to the socket
+                sent = sock.sendfile(payload_file, 0, payload_size)
+                if sent != payload_size:
+                    raise ConnectionError(f"Payload file shrank while sending: {sent}/{payload_size} bytes")
+                if drop_cache and hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(payload_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
             return True
 
         except Exception as e:
-            self.logger.error(f"Error sending message: {e}")
+            self.logger.error("Error sending message: %s", e)
             return False
 
-    def receive_message(self, sock) -> Tuple[Optional[Dict], Optional[str], Optional[bytes]]:
+        finally:
+            if corked:
+                # Uncorking flushes any partial final segment
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+                except OSError:
+                    pass
+            if payload_file:
+                payload_file.close()
+
+    @staticmethod
+    def _sendmsg_all(sock, buffers: List[bytes]):
+        """
+        Send all buffers, using scatter-gather sendmsg where available
+        
+        Args:
+            sock: Socket to send through
+            buffers: Byte buffers to send in order
+        """
+        if not hasattr(sock, 'sendmsg'):
+            # e.g. Windows
+            for buf in buffers:
+                sock.sendall(buf)
+            return
+
+        views = [memoryview(buf) for buf in buffers]
+        while views:
+            sent = sock.sendmsg(views)
+            # Drop fully sent buffers and trim a partially sent one
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
+
+    @staticmethod
+    def _recv_exact(sock, size: int) -> Tuple[bytearray, int]:
+        """
+        Receive up to size bytes into a preallocated buffer
+        
+        Args:
+            sock: Socket to receive from
+            size: Number of bytes expected
+            
+        Returns:
+            Tuple[bytearray, int]: (buffer, bytes received); fewer than size only if the peer closed
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            n = sock.recv_into(view[offset:offset + min(MMPProtocol.RECV_CHUNK_SIZE, size - offset)])
+            if not n:
+                break
+            offset += n
+        return buf, offset
+
+    def receive_message(self, sock) -> Tuple[Optional[Dict], Optional[str], Optional[bytearray]]:
         """
         Receive a message following the MMP protocol
         
@@ -161,13 +262,42 @@ class MMPProtocol:
             sock: Socket to receive from
             
         Returns:
-            Tuple[Optional[Dict], Optional[str], Optional[bytes]]: 
+            Tuple[Optional[Dict], Optional[str], Optional[bytearray]]: 
             (JSON data, media type, payload)
         """
+        json_data, media_type, payload_size = self.receive_message_head(sock)
+
+        # Receive payload if present, straight into one buffer of its final size
+        payload = None
+        if payload_size > 0:
+            payload, received = self._recv_exact(sock, payload_size)
+            if received != payload_size:
+                self.logger.error("Error receiving message: Connection lost while receiving payload")
+                return None, None, None
+
+        return json_data, media_type, payload
+
+    def receive_message_head(self, sock) -> Tuple[Optional[Dict], Optional[str], int]:
+        """
+        Receive the header, JSON and media type of a message, leaving the payload unread
+        
+        The caller must then consume exactly payload_size bytes, e.g. with
+        receive_payload_into, before the next message can be read.
+        
+        Args:
+            sock: Socket to receive from
+            
+        Returns:
+            Tuple[Optional[Dict], Optional[str], int]: 
+            (JSON data, media type, payload size); (None, None, 0) on error or EOF
+        """
         try:
             # Receive and parse header
-            header = sock.recv(self.HEADER_SIZE)
-            if not header or len(header) != self.HEADER_SIZE:
+            header, received = self._recv_exact(sock, self.HEADER_SIZE)
+            if not received:
+                # Peer closed the connection between messages
+                return None, None, 0
+            if received != self.HEADER_SIZE:
                 raise ConnectionError("Failed to receive complete header")
 
             json_size, media_type_size, payload_size = self.parse_header(header)
@@ -175,35 +305,206 @@ class MMPProtocol:
             # Receive JSON if present
             json_data = None
             if json_size > 0:
-                json_bytes = sock.recv(json_size)
-                if len(json_bytes) != json_size:
+                json_bytes, received = self._recv_exact(sock, json_size)
+                if received != json_size:
                     raise ConnectionError("Failed to receive complete JSON data")
-                json_data = json.loads(json_bytes)
+                json_data = json_loads(json_bytes)
 
             # Receive media type if present
             media_type = None
             if media_type_size > 0:
-                media_type_bytes = sock.recv(media_type_size)
-                if len(media_type_bytes) != media_type_size:
+                media_type_bytes, received = self._recv_exact(sock, media_type_size)
+                if received != media_type_size:
                     raise ConnectionError("Failed to receive complete media type")
                 media_type = media_type_bytes.decode()
 
-            # Receive payload if present
-            payload = None
-            if payload_size > 0:
-                payload = b''
-                remaining = payload_size
-                while remaining > 0:
-                    chunk = sock.recv(min(8192, remaining))
-                    if not chunk:
-                        raise ConnectionError("Connection lost while receiving payload")
-                    payload += chunk
-                    remaining -= len(chunk)
+            return json_data, media_type, payload_size
+
+        except Exception as e:
+            self.logger.error("Error receiving message: %s", e)
+            return None, None, 0
+
+    @staticmethod
+    def receive_payload_into(sock, payload_sink: Optional[BinaryIO], payload_size: int,
+                             chunk_size: int = RECV_CHUNK_SIZE):
+        """
+        Stream a payload from the socket into a file, one chunk at a time
+        
+        Args:
+            sock: Socket to receive from
+            payload_sink: File object opened for binary writing, or None to discard the payload
+            payload_size: Number of payload bytes to consume
+            chunk_size: Size of the reusable receive buffer
+            
+        Raises:
+            ConnectionError: If the peer closes before the whole payload arrived
+        """
+        view = memoryview(bytearray(min(chunk_size, payload_size)))
+        remaining = payload_size
+        while remaining:
+            # Fill the whole buffer before writing it out, so the file sees one
+            # write per chunk rather than one per (often much smaller) recv
+            target = min(len(view), remaining)
+            filled = 0
+            while filled < target:
+                n = sock.recv_into(view[filled:target])
+                if not n:
+                    raise ConnectionError("Connection lost while receiving payload")
+                filled += n
+            if payload_sink is not None:
+                # Unbuffered files may write less than asked
+                written = 0
+                while written < filled:
+                    written += payload_sink.write(view[written:filled])
+            remaining -= filled
+
+    def receive_message_streaming(self, sock, payload_sink: Optional[BinaryIO],
+                                  chunk_size: int = RECV_CHUNK_SIZE) -> Tuple[Optional[Dict], Optional[str], int]:
+        """
+        Receive a message, writing its payload into payload_sink instead of memory
+        
+        Peak memory use is one chunk rather than the whole payload.
+        
+        Args:
+            sock: Socket to receive from
+            payload_sink: File object opened for binary writing, or None to discard the payload
+            chunk_size: Size of the reusable receive buffer
+            
+        Returns:
+            Tuple[Optional[Dict], Optional[str], int]: 
+            (JSON data, media type, payload size)
+        """
+        json_data, media_type, payload_size = self.receive_message_head(sock)
+        if payload_size > 0:
+            try:
+                self.receive_payload_into(sock, payload_sink, payload_size, chunk_size)
+            except Exception as e:
+                self.logger.error("Error receiving message: %s", e)
+                return None, None, 0
+        return json_data, media_type, payload_size
+
+    def receive_small_message(self, sock) -> Tuple[Optional[Dict], Optional[str], Optional[bytes]]:
+        """
+        Receive a reply that is expected to be small, usually with a single recv
+        
+        Header and JSON of a status-style reply arrive together, so both are read with
+        one syscall instead of one per part. Only for request/response exchanges where
+        the peer sends nothing after this message: any bytes beyond it would be lost.
+        
+        Args:
+            sock: Socket to receive from
+            
+        Returns:
+            Tuple[Optional[Dict], Optional[str], Optional[bytes]]: 
+            (JSON data, media type, payload)
+        """
+        try:
+            data = sock.recv(self.SMALL_MESSAGE_SIZE)
+            if not data:
+                return None, None, None
+            if len(data) < self.HEADER_SIZE:
+                rest, received = self._recv_exact(sock, self.HEADER_SIZE - len(data))
+                data += rest[:received]
+                if len(data) != self.HEADER_SIZE:
+                    raise ConnectionError("Failed to receive complete header")
+
+            json_size, media_type_size, payload_size = self.parse_header(data[:self.HEADER_SIZE])
+            message_size = self.HEADER_SIZE + json_size + media_type_size + payload_size
+
+            # Larger than the first read: receive the remainder
+            if len(data) < message_size:
+                rest, received = self._recv_exact(sock, message_size - len(data))
+                if received != message_size - len(data):
+                    raise ConnectionError("Connection lost while receiving message")
+                data += rest
+            elif len(data) > message_size:
+                raise ConnectionError("Received data beyond the end of the message")
+
+            view = memoryview(data)
+            offset = self.HEADER_SIZE
+            json_data = json_loads(view[offset:offset + json_size]) if json_size > 0 else None
+            offset += json_size
+            media_type = view[offset:offset + media_type_size].tobytes().decode() if media_type_size > 0 else None
+            offset += media_type_size
+            payload = view[offset:].tobytes() if payload_size > 0 else None
+
+            return json_data, media_type, payload
+
+        except Exception as e:
+            self.logger.error("Error receiving message: %s", e)
+            return None, None, None
+
+    async def send_message_async(self, writer: asyncio.StreamWriter, json_data: Optional[Dict] = None,
+                                 media_type: Optional[str] = None, payload: Optional[bytes] = None,
+                                 payload_path: Optional[str] = None) -> bool:
+        """
+        Send a message following the MMP protocol over an asyncio stream
+        
+        Args:
+            writer: Stream writer to send through
+            json_data: Optional JSON data to send
+            media_type: Optional media type string
+            payload: Optional payload bytes
+            payload_path: Optional file to send as the payload instead of payload
+            
+        Returns:
+            bool: True if send was successful
+        """
+        try:
+            json_bytes = json_dumps(json_data) if json_data else b''
+            media_type_bytes = media_type.encode() if media_type else b''
+
+            if payload_path:
+                with open(payload_path, 'rb') as payload_file:
+                    payload_size = os.fstat(payload_file.fileno()).st_size
+                    header = self.create_header(len(json_bytes), len(media_type_bytes), payload_size)
+                    writer.writelines([header, json_bytes, media_type_bytes])
+                    await writer.drain()
+                    # Uses os.sendfile when the transport supports it (it rejects a zero count)
+                    if payload_size > 0:
+                        await asyncio.get_running_loop().sendfile(writer.transport, payload_file, 0, payload_size)
+            else:
+                payload_size = len(payload) if payload else 0
+                header = self.create_header(len(json_bytes), len(media_type_bytes), payload_size)
+                writer.writelines([header, json_bytes, media_type_bytes, payload or b''])
+                await writer.drain()
+
+            return True
+
+        except Exception as e:
+            self.logger.error("Error sending message: %s", e)
+            return False
+
+    async def receive_message_async(self, reader: asyncio.StreamReader) -> Tuple[Optional[Dict], Optional[str], Optional[bytes]]:
+        """
+        Receive a message following the MMP protocol from an asyncio stream
+        
+        Args:
+            reader: Stream reader to receive from
+            
+        Returns:
+            Tuple[Optional[Dict], Optional[str], Optional[bytes]]: 
+            (JSON data, media type, payload)
+        """
+        try:
+            try:
+                header = await reader.readexactly(self.HEADER_SIZE)
+            except asyncio.IncompleteReadError as e:
+                if not e.partial:
+                    # Peer closed the connection between messages
+                    return None, None, None
+                raise ConnectionError("Failed to receive complete header")
+
+            json_size, media_type_size, payload_size = self.parse_header(header)
+
+            json_data = json_loads(await reader.readexactly(json_size)) if json_size > 0 else None
+            media_type = (await reader.readexactly(media_type_size)).decode() if media_type_size > 0 else None
+            payload = await reader.readexactly(payload_size) if payload_size > 0 else None
 
             return json_data, media_type, payload
 
         except Exception as e:
-            self.logger.error(f"Error receiving message: {e}")
+            self.logger.error("Error receiving message: %s", e)
             return None, None, None
 
     def send_error(self, sock, error_code: int, description: str, solution: str) -> bool:
@@ -220,4 +521,72 @@ class MMPProtocol:
             bool: True if send was successful
         """
         error_response = self.create_error_response(error_code, description, solution)
-        return self.send_message(sock, json_data=error_response)
\ No newline at end of file
+        return self.send_message(sock, json_data=error_response)
+
+    @classmethod
+    def benchmark_throughput(cls, payload_size: int = 64 * 1024 * 1024, count: int = 16,
+                             json_count: int = 10000) -> Dict[str, float]:
+        """
+        Measure send_message/receive_message throughput over a loopback TCP connection
+        
+        Compares bulk payload transfer (bytes/sec, bound by memory copies) with small
+        JSON-only messages (messages/sec, bound by per-message overhead).
+        
+        Args:
+            payload_size: Size of each zero-filled payload in bytes
+            count: Number of payload messages to send
+            json_count: Number of JSON-only messages to send
+            
+        Returns:
+            Dict with 'payload_bytes_per_sec' and 'json_messages_per_sec'
+        """
+        protocol = cls()
+        listener = socket.create_server(('127.0.0.1', 0))
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _ = listener.accept()
+        listener.close()
+        sender.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def timed_transfer(n: int, **message) -> float:
+            thread = threading.Thread(
+                target=lambda: [protocol.send_message(sender, **message) for _ in range(n)]
+            )
+            start = time.perf_counter()
+            thread.start()
+            for _ in range(n):
+                protocol.receive_message(receiver)
+            elapsed = time.perf_counter() - start
+            thread.join()
+            return elapsed
+
+        try:
+            payload_elapsed = timed_transfer(count, media_type='bin', payload=bytes(payload_size))
+            json_elapsed = timed_transfer(json_count, json_data={'action': 'status', 'task_id': 'benchmark'})
+        finally:
+            sender.close()
+            receiver.close()
+
+        return {
+            'payload_bytes_per_sec': payload_size * count / payload_elapsed,
+            'json_messages_per_sec': json_count / json_elapsed
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='MMP protocol utilities')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Measure loopback send/receive throughput')
+    parser.add_argument('--payload-size', type=int, default=64,
+                        help='Payload size in MB for the benchmark (default: 64)')
+    parser.add_argument('--count', type=int, default=16,
+                        help='Number of payload messages for the benchmark (default: 16)')
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+    else:
+        results = MMPProtocol.benchmark_throughput(args.payload_size * 1024 * 1024, args.count)
+        print(f"Payload throughput: {results['payload_bytes_per_sec'] / 1024**3:.2f} GB/sec")
+        print(f"JSON-only messages: {results['json_messages_per_sec']:,.0f} messages/sec")
@@ -1,13 +1,23 @@
 # server/performance_manager.py
 
 import os
+import errno
+import mmap
+import tempfile
 import time
 import psutil
-from datetime import datetime
 import logging
-from typing import Dict, Tuple, Optional
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Tuple, Optional
 from common.logging_config import LogConfig
 
+@dataclass
+class SystemSnapshot:
+    """System resource readings taken together for one admission check"""
+    cpu_available: float  # Percent of CPU not in use
+    memory: Any  # psutil.virtual_memory() result
+    disk: Any  # psutil.disk_usage() result for the upload directory
+
 class PerformanceManager:
     """Manages server performance requirements and monitoring"""
     
@@ -22,6 +32,57 @@ class PerformanceManager:
         if not os.path.exists(upload_dir):
             os.makedirs(upload_dir)
 
+        # IO probe buffer, allocated once and reused by every check_io_performance call.
+        # Anonymous mappings are page-aligned and zero-filled on demand, and the size is
+        # rounded up to the filesystem block size so it can also be written with O_DIRECT
+        block_size = mmap.PAGESIZE
+        if hasattr(os, 'statvfs'):
+            block_size = max(block_size, os.statvfs(upload_dir).f_bsize)
+        self._probe_buf = mmap.mmap(-1, -(-self.io_buffer_size // block_size) * block_size)
+
+        # Recent psutil readings: key -> (value, expires_at)
+        self.resource_cache_ttl = 0.5
+        self._resource_cache: Dict[str, Tuple[Any, float]] = {}
+
+        # Length of the blocking CPU sample taken for an admission check
+        self.cpu_sample_interval = 0.2
+
+    def _psutil_cached(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Return fn() from a short-lived cache so back-to-back checks share one reading"""
+        now = time.monotonic()
+        entry = self._resource_cache.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        value = fn()
+        self._resource_cache[key] = (value, now + self.resource_cache_ttl)
+        return value
+
+    def _cpu_percent(self) -> float:
+        """
+        CPU usage over a short fresh sample
+        
+        A non-blocking cpu_percent() would average over everything since the previous
+        admission check, i.e. the whole encode that just finished, and reject the next
+        task on CPU that is already free again.
+        """
+        return self._psutil_cached(
+            'cpu_percent', lambda: psutil.cpu_percent(interval=self.cpu_sample_interval)
+        )
+
+    def _virtual_memory(self):
+        return self._psutil_cached('virtual_memory', psutil.virtual_memory)
+
+    def _disk_usage(self):
+        return self._psutil_cached('disk_usage', lambda: psutil.disk_usage(self.upload_dir))
+
+    def _snapshot_system_state(self) -> SystemSnapshot:
+        """Read CPU, memory and disk once, for use by every check and the log output"""
+        return SystemSnapshot(
+            cpu_available=100 - self._cpu_percent(),
+            memory=self._virtual_memory(),
+            disk=self._disk_usage()
+        )
+
     def check_system_resources(self) -> Tuple[bool, str]:
         """
         総合的なシステムリソースチェック
@@ -29,13 +90,16 @@ class PerformanceManager:
         Returns:
             Tuple[bool, str]: (要件を満たしているか, メッセージ)
         """
+        # CPU・メモリ・ディスクの値は最初に一度だけ取得し、各チェックとログ出力で共有する
+        snapshot = self._snapshot_system_state()
+
         # 1. CPU使用率のチェック
-        cpu_available = 100 - psutil.cpu_percent(interval=1)
+        cpu_available = snapshot.cpu_available
         if cpu_available < self.min_processing_cpu_percent:
             return False, f"Insufficient CPU available. Need {self.min_processing_cpu_percent}%, but only {cpu_available}% available"
 
         # 2. メモリ使用率のチェック
-        memory = psutil.virtual_memory()
+        memory = snapshot.memory
         if memory.available < 2 * 1024 * 1024 * 1024:  # 2GB未満
             return False, f"Insufficient memory. Only {memory.available / (1024*1024*1024):.1f}GB available"
 
@@ -45,11 +109,11 @@ class PerformanceManager:
             return False, f"IO performance insufficient. Current: {stats['actual_pps']:.0f} packets/sec, Required: {self.min_packets_per_second}"
 
         # 4. ディスク容量のチェック
-        if not self._check_disk_space():
+        if not self._check_disk_space(snapshot.disk):
             return False, "Insufficient disk space"
 
         # 全てのチェックをパス
-        self._log_performance_results(stats, True)
+        self._log_performance_results(stats, True, snapshot)
         return True, "All system requirements met"
 
     def check_io_performance(self) -> Tuple[Dict[str, float], bool]:
@@ -59,21 +123,19 @@ class PerformanceManager:
         Returns:
             Tuple[Dict[str, float], bool]: (performance stats, meets requirements)
         """
-        test_file = os.path.join(self.upload_dir, 'perf_test')
-        test_data = b'x' * self.packet_size
+        # A file of its own per probe: several workers run admission checks at once
+        fd, test_file = tempfile.mkstemp(prefix='perf_test_', dir=self.upload_dir)
+        os.close(fd)
         
         try:
-            start_time = datetime.now()
+            start = time.perf_counter_ns()
             
-            # Write test data
-            with open(test_file, 'wb', buffering=self.io_buffer_size) as f:
-                for _ in range(self.min_packets_per_second):
-                    f.write(test_data)
-                f.flush()
-                os.fsync(f.fileno())
+            # Write test data: one second's worth of packets in one call, which measures
+            # the disk rather than the overhead of a Python-level write() per packet
+            self._write_test_file(test_file, self.io_buffer_size)
             
             # Calculate performance metrics
-            elapsed = (datetime.now() - start_time).total_seconds()
+            elapsed = (time.perf_counter_ns() - start) / 1e9
             actual_pps = self.min_packets_per_second / elapsed
             
             # Calculate statistics
@@ -83,17 +145,70 @@ class PerformanceManager:
             return stats, meets_requirement
             
         finally:
-            if os.path.exists(test_file):
+            try:
                 os.remove(test_file)
+            except FileNotFoundError:
+                pass
 
-    def _check_disk_space(self) -> bool:
+    def _write_test_file(self, test_file: str, size: int):
+        """
+        Write size bytes to test_file and sync them to disk
+        
+        Uses O_DIRECT with a page-aligned buffer where the filesystem supports it, so
+        the probe measures the device and doesn't fill the page cache; otherwise falls
+        back to a normal write followed by fdatasync.
+        """
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                self._write_test_file_direct(test_file, size)
+                return
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Filesystem doesn't support O_DIRECT (e.g. tmpfs)
+
+        fd = os.open(test_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            with memoryview(self._probe_buf) as view:
+                self._write_all(fd, view[:size])
+            self._sync_data(fd)
+        finally:
+            os.close(fd)
+
+    def _write_test_file_direct(self, test_file: str, size: int):
+        """Write size bytes (rounded up to the block size) with O_DIRECT"""
+        # O_DIRECT needs the buffer, length and offset aligned to the block size;
+        # the probe buffer is allocated that way in __init__
+        fd = os.open(test_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        try:
+            with memoryview(self._probe_buf) as view:
+                self._write_all(fd, view)
+            self._sync_data(fd)  # Data is on the device already; this flushes the size/allocation
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _sync_data(fd: int):
+        """fdatasync where available: flushes the data without a journal commit for timestamps"""
+        getattr(os, 'fdatasync', os.fsync)(fd)
+
+    @staticmethod
+    def _write_all(fd: int, view: memoryview):
+        """Write the whole buffer, retrying only if a write was short"""
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _check_disk_space(self, disk=None) -> bool:
         """
         ディスク容量のチェック
         
+        Args:
+            disk: 取得済みのpsutil.disk_usageの結果（省略時は取得する）
+        
         Returns:
             bool: 十分な容量があるか
         """
-        stats = psutil.disk_usage(self.upload_dir)
+        stats = disk if disk is not None else self._disk_usage()
         required_space = 10 * 1024 * 1024 * 1024  # 最低10GB必要とする
         return stats.free >= required_space
 
@@ -116,8 +231,11 @@ class PerformanceManager:
             'packet_size_bytes': float(self.packet_size)
         }
 
-    def _format_performance_results(self, stats: Dict[str, float]) -> str:
-        """Format performance results as string"""
+    def _format_performance_results(self, stats: Dict[str, float],
+                                    snapshot: Optional[SystemSnapshot] = None) -> str:
+        """Format performance results as string, taking a resource snapshot if none is passed in"""
+        if snapshot is None:
+            snapshot = self._snapshot_system_state()
         return f"""
 Performance Results
 -----------------
@@ -133,14 +251,15 @@ Required Transfer Rate: {stats['required_mbps']:.2f} MB/sec ({stats['required_pp
 
 System Resources
 --------------
-CPU Available: {100 - psutil.cpu_percent()}%
-Memory Available: {psutil.virtual_memory().available / (1024*1024*1024):.1f}GB
-Disk Space Available: {psutil.disk_usage(self.upload_dir).free / (1024*1024*1024):.1f}GB
+CPU Available: {snapshot.cpu_available}%
+Memory Available: {snapshot.memory.available / (1024*1024*1024):.1f}GB
+Disk Space Available: {snapshot.disk.free / (1024*1024*1024):.1f}GB
 """
 
-    def _log_performance_results(self, stats: Dict[str, float], meets_requirement: bool):
+    def _log_performance_results(self, stats: Dict[str, float], meets_requirement: bool,
+                                 snapshot: Optional[SystemSnapshot] = None):
         """Log performance results"""
-        result_str = self._format_performance_results(stats)
+        result_str = self._format_performance_results(stats, snapshot)
         if meets_requirement:
             self.logger.info("Performance requirements met")
         else:
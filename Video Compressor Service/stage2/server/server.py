@@ -3,9 +3,14 @@
 import os
 import signal
 import logging
+import select
+import selectors
 import socket
 import threading
-from typing import Dict, Any, Optional
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from common.logging_config import LogConfig
 import argparse
 
@@ -18,6 +23,25 @@ from storage_manager import StorageManager
 class VideoProcessingServer:
     """Main video processing server implementation"""
     
+    # Actions understood by handle_client, reported to clients by 'capabilities'
+    CAPABILITIES = ['upload', 'status', 'batch_status', 'download', 'subscribe', 'capabilities']
+    
+    # Output file extension for each task type
+    OUTPUT_EXTENSIONS = {
+        'compress': 'mp4',
+        'resolution': 'mp4',
+        'aspect_ratio': 'mp4',
+        'extract_audio': 'mp3',
+        'gif': 'gif',
+        'webm': 'webm'
+    }
+    
+    # Upper bound on tasks (FFmpeg processes) run at the same time
+    MAX_CONCURRENT_TASKS = 4
+    
+    # Send/receive buffer size for client connections (uploads and downloads are bulk transfers)
+    SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+    
     def __init__(self, host: str = 'localhost', port: int = 9999, work_dir: str = 'work'):
         """
         Initialize server with all components
@@ -33,6 +57,24 @@ class VideoProcessingServer:
         self.running = False
         self.server_socket = None
         
+        # Connections are served by a bounded pool of worker threads; beyond
+        # max_pending_connections waiting for a worker, new clients are turned away
+        self.max_workers = min(32, (os.cpu_count() or 1) * 4)
+        self.max_pending_connections = self.max_workers
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="vp-worker")
+        self._connections = 0  # Connections being served or waiting for a worker
+        self._connections_lock = threading.Lock()
+        
+        # Connections waiting on a 'subscribe' are parked here instead of holding a
+        # pool worker: socket -> (task ID, client IP, deadline). Guarded by the task
+        # processor's task_finished condition, which _serve_subscriptions waits on
+        self._subscriptions: Dict[socket.socket, Tuple[str, str, float]] = {}
+        self._subscription_thread = None
+        
+        # Written to by shutdown() to wake the accept loop; a socket pair rather than
+        # os.pipe() so it can be selected on Windows as well
+        self._wake_r, self._wake_w = socket.socketpair()
+        
         # Ensure work directory exists
         os.makedirs(work_dir, exist_ok=True)
         
@@ -48,10 +90,19 @@ class VideoProcessingServer:
             self.protocol = MMPProtocol()
             self.performance_manager = PerformanceManager(self.work_dir)
             self.storage_manager = StorageManager(self.work_dir)
-            self.video_processor = VideoProcessor(self.work_dir)
+            # One task per core up to MAX_CONCURRENT_TASKS, with the cores split
+            # between their FFmpeg processes
+            cpu_count = os.cpu_count() or 1
+            num_workers = max(1, min(cpu_count, self.MAX_CONCURRENT_TASKS))
+            self.video_processor = VideoProcessor(
+                self.work_dir,
+                ffmpeg_threads=max(1, cpu_count // num_workers)
+            )
             self.task_processor = TaskProcessor(
                 self.video_processor,
-                self.performance_manager
+                self.performance_manager,
+                num_workers=num_workers,
+                on_task_completed=self._register_output
             )
             
             # Verify system requirements
@@ -89,86 +140,204 @@ class VideoProcessingServer:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Set on the listener so accepted sockets inherit the sizes, and the TCP
+            # window scale negotiated in the handshake is large enough to use them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUFFER_SIZE)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUFFER_SIZE)
             self.server_socket.bind((self.host, self.port))
             self.server_socket.listen(5)
             
+            self.server_socket.setblocking(False)
+            
+            # Wait for either a new connection or a shutdown wakeup
+            selector = selectors.DefaultSelector()
+            selector.register(self.server_socket, selectors.EVENT_READ)
+            selector.register(self._wake_r, selectors.EVENT_READ)
+            
             self.running = True
+            self._subscription_thread = threading.Thread(
+                target=self._serve_subscriptions, name="vp-subscriptions", daemon=True
+            )
+            self._subscription_thread.start()
             self.logger.info(f"Server started on {self.host}:{self.port}")
             print(f"Server is running on {self.host}:{self.port}")
             
             while self.running:
                 try:
+                    events = selector.select(timeout=1.0)
+                    if not self.running or any(key.fileobj is self._wake_r for key, _ in events):
+                        break
+                    if not events:
+                        continue
                     client_socket, address = self.server_socket.accept()
                     self.logger.info(f"New connection from {address}")
+                    self._configure_client_socket(client_socket)
+                    
+                    with self._connections_lock:
+                        busy = self._connections >= self.max_workers + self.max_pending_connections
+                        if not busy:
+                            self._connections += 1
+                    if busy:
+                        self.logger.warning(f"Rejecting connection from {address}: server busy")
+                        self._send_error(client_socket, "Server busy")
+                        client_socket.close()
+                        continue
                     
-                    # Start client handler in new thread
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, address[0])
-                    )
-                    client_thread.start()
+                    # Hand the connection to the worker pool
+                    self._executor.submit(self.handle_client, client_socket, address[0])
+                    
+                except BlockingIOError:
+                    # The pending connection went away before accept()
+                    continue
                     
                 except socket.error as e:
                     if self.running:
                         self.logger.error(f"Socket error: {e}")
                         
+            selector.close()
+                        
         except Exception as e:
             self.logger.error(f"Server error: {e}")
             self.shutdown()
 
-    def handle_client(self, client_socket: socket.socket, client_ip: str):
+    def _configure_client_socket(self, client_socket: socket.socket):
+        """Enable keepalive so dead peers are detected, and bound blocking operations"""
+        # Replies go out immediately instead of waiting on Nagle's algorithm
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 120)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+        # Fallback for platforms without the keepalive timers above
+        client_socket.settimeout(600)
+
+    def handle_client(self, client_socket: socket.socket, client_ip: str, handled: int = 0):
         """
         Handle client connection
         
         Args:
             client_socket: Client socket
             client_ip: Client IP address
+            handled: Requests already served on this connection (when resumed
+                after a parked subscription)
         """
+        parked = False
         try:
-            # Receive request using MMP protocol
-            json_data, media_type, payload = self.protocol.receive_message(client_socket)
-            
-            if not json_data:
-                self.logger.error("Failed to receive request")
-                self._send_error(client_socket, "Invalid request")
-                return
+            # Serve requests on this connection until the client closes it,
+            # so a client can reuse one connection for upload, status and download
+            while self.running:
+                # Wait for the next request, checking periodically so an idle
+                # kept-alive connection doesn't keep the server from shutting down
+                readable, _, _ = select.select([client_socket], [], [], 1.0)
+                if not readable:
+                    if handled and self._connections > self.max_workers:
+                        # Connections are queued for a worker; give this idle one up
+                        # (the client reconnects when it next needs the server)
+                        return
+                    continue
                 
-            # Process request based on action
-            if json_data.get('action') == 'upload':
-                self._handle_upload(client_socket, json_data, media_type, payload, client_ip)
-            elif json_data.get('action') == 'status':
-                self._handle_status(client_socket, json_data)
-            elif json_data.get('action') == 'download':
-                self._handle_download(client_socket, json_data)
-            else:
-                self._send_error(client_socket, "Unknown action")
+                # Receive request using MMP protocol; an upload payload is
+                # left on the socket for _handle_upload to stream to disk
+                json_data, media_type, payload_size = self.protocol.receive_message_head(client_socket)
                 
+                if not json_data:
+                    if not handled:
+                        self.logger.error("Failed to receive request")
+                        self._send_error(client_socket, "Invalid request")
+                    return
+                    
+                # Process request based on action
+                if json_data.get('action') == 'upload':
+                    self._handle_upload(client_socket, json_data, media_type, payload_size, client_ip)
+                    handled += 1
+                    continue
+                
+                if payload_size:
+                    # Other actions carry no payload; skip any so the next request lines up
+                    self.protocol.receive_payload_into(client_socket, None, payload_size)
+                    
+                if json_data.get('action') == 'status':
+                    self._handle_status(client_socket, json_data)
+                elif json_data.get('action') == 'batch_status':
+                    self._handle_batch_status(client_socket, json_data)
+                elif json_data.get('action') == 'download':
+                    self._handle_download(client_socket, json_data)
+                elif json_data.get('action') == 'subscribe':
+                    if self._handle_subscribe(client_socket, json_data, client_ip):
+                        # _serve_subscriptions replies and hands the connection back
+                        parked = True
+                        return
+                elif json_data.get('action') == 'capabilities':
+                    self.protocol.send_message(client_socket, json_data={'capabilities': self.CAPABILITIES})
+                else:
+                    self._send_error(client_socket, "Unknown action")
+                handled += 1
+                
+        except ConnectionError as e:
+            # The connection is unusable, so there is no point replying
+            self.logger.error(f"Client connection lost: {e}")
+            
         except Exception as e:
             self.logger.error(f"Error handling client: {e}")
             self._send_error(client_socket, str(e))
             
         finally:
-            client_socket.close()
+            if not parked:
+                client_socket.close()
+            with self._connections_lock:
+                self._connections -= 1
 
     def _handle_upload(self, client_socket: socket.socket, request: Dict[str, Any],
-                      media_type: str, payload: bytes, client_ip: str):
-        """Handle file upload and processing request"""
+                      media_type: str, payload_size: int, client_ip: str):
+        """
+        Handle file upload and processing request
+        
+        The payload is still unread on client_socket and is streamed straight
+        into the input file, so memory use does not grow with the upload size.
+        
+        Raises:
+            ConnectionError: If the payload could not be fully consumed, which
+                leaves the connection out of sync
+        """
+        input_path = None
+        file_id = None
         try:
             # Verify storage availability
-            if not payload:
+            if not payload_size:
                 raise ValueError("No file data received")
                 
-            storage_ok, msg = self.storage_manager.check_storage_available(len(payload))
+            if request.get('type') not in self.task_processor.TASK_TYPES:
+                # Fail before storing a file that no task could process
+                self.protocol.receive_payload_into(client_socket, None, payload_size)
+                raise ValueError(f"Unknown task type: {request.get('type')}")
+                
+            storage_ok, msg = self.storage_manager.check_storage_available(payload_size)
             if not storage_ok:
+                # Consume the rejected upload so the connection stays usable
+                self.protocol.receive_payload_into(client_socket, None, payload_size)
                 raise ValueError(f"Storage check failed: {msg}")
                 
             # Save input file
-            input_path = os.path.join(self.work_dir, f"input_{media_type}")
-            with open(input_path, 'wb') as f:
-                f.write(payload)
+            # A unique name per upload, since several tasks can now be queued or running
+            input_path = os.path.join(self.work_dir, f"input_{uuid.uuid4().hex}.{media_type}")
+            try:
+                with open(input_path, 'wb', buffering=0) as f:
+                    self.protocol.receive_payload_into(client_socket, f, payload_size)
+                    if hasattr(os, 'posix_fadvise'):
+                        # ffmpeg reads the whole input next; keep or bring it back into the page cache
+                        os.posix_fadvise(f.fileno(), 0, payload_size, os.POSIX_FADV_WILLNEED)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                # e.g. disk full part way through; the rest of the payload is still in flight
+                self._send_error(client_socket, str(e))
+                raise ConnectionError(f"Upload aborted: {e}")
                 
-            # Register file with storage manager
-            file_id = self.storage_manager.register_file(input_path, "temp")
+            # Register file with storage manager under the task's ID (chosen now), so
+            # cleanup_task_files removes it together with the output after download
+            task_id = str(uuid.uuid4())
+            file_id = self.storage_manager.register_file(input_path, task_id)
             if not file_id:
                 raise RuntimeError("Failed to register input file")
                 
@@ -177,15 +346,14 @@ class VideoProcessingServer:
             output_path = os.path.join(self.work_dir, f"output_{output_ext}")
             
             # Add task to processor
-            task_id = self.task_processor.add_task(
+            if not self.task_processor.add_task(
                 client_ip,
                 request['type'],
                 input_path,
                 output_path,
-                request.get('parameters', {})
-            )
-            
-            if not task_id:
+                request.get('parameters', {}),
+                task_id=task_id
+            ):
                 raise RuntimeError("Failed to create processing task")
                 
             # Send success response
@@ -196,12 +364,26 @@ class VideoProcessingServer:
             }
             self.protocol.send_message(client_socket, json_data=response)
             
+        except ConnectionError:
+            self._discard_upload(input_path, file_id)
+            raise
+            
         except Exception as e:
             self.logger.error(f"Upload error: {e}")
             self._send_error(client_socket, str(e))
-            # Cleanup any created files
-            if 'input_path' in locals():
-                self.storage_manager.remove_file(file_id)
+            self._discard_upload(input_path, file_id)
+
+    def _register_output(self, task):
+        """Track a finished task's output like its input, so it expires or is removed after download"""
+        if not self.storage_manager.register_file(task.output_path, task.id):
+            self.logger.warning(f"Output of task {task.id} is not tracked and won't be cleaned up")
+
+    def _discard_upload(self, input_path: Optional[str], file_id: Optional[str]):
+        """Remove the input file of a failed upload, registered or not"""
+        if file_id:
+            self.storage_manager.remove_file(file_id)
+        elif input_path and os.path.exists(input_path):
+            os.remove(input_path)
 
     def _handle_status(self, client_socket: socket.socket, request: Dict[str, Any]):
         """Handle task status request"""
@@ -217,6 +399,104 @@ class VideoProcessingServer:
             
         self.protocol.send_message(client_socket, json_data=status)
 
+    def _handle_batch_status(self, client_socket: socket.socket, request: Dict[str, Any]):
+        """Handle a status request for several tasks; unknown tasks map to None"""
+        task_ids = request.get('task_ids')
+        if not isinstance(task_ids, list):
+            self._send_error(client_socket, "Task ID list required")
+            return
+            
+        statuses = {
+            task_id: self.task_processor.get_task_status(task_id)
+            for task_id in task_ids
+        }
+        self.protocol.send_message(client_socket, json_data={'statuses': statuses})
+
+    def _handle_subscribe(self, client_socket: socket.socket, request: Dict[str, Any],
+                          client_ip: str) -> bool:
+        """
+        Reply with the task status once the task completes or fails (or the timeout expires)
+        
+        A task that is still queued or processing is not waited for here: the
+        connection is parked for _serve_subscriptions, so a subscriber doesn't hold
+        a pool worker for up to its timeout.
+        
+        Returns:
+            bool: True if the connection was parked
+        """
+        task_id = request.get('task_id')
+        if not task_id:
+            self._send_error(client_socket, "Task ID required")
+            return False
+            
+        timeout = float(request.get('timeout', 3600))
+        
+        # Check and park under the condition, so a task finishing in between
+        # still wakes _serve_subscriptions
+        with self.task_processor.task_finished:
+            status = self.task_processor.get_task_status(task_id)
+            if (status and status['status'] not in ('completed', 'failed')
+                    and timeout > 0 and self.running):
+                self._subscriptions[client_socket] = (task_id, client_ip, time.monotonic() + timeout)
+                return True
+                
+        if not status:
+            self._send_error(client_socket, "Task not found")
+        else:
+            self.protocol.send_message(client_socket, json_data=status)
+        return False
+
+    def _due_subscriptions(self) -> List[socket.socket]:
+        """Parked connections whose task finished or disappeared, or whose timeout expired"""
+        now = time.monotonic()
+        due = []
+        for sock, (task_id, _, deadline) in self._subscriptions.items():
+            task = self.task_processor.tasks.get(task_id)
+            if task is None or task.status in ('completed', 'failed') or now >= deadline:
+                due.append(sock)
+        return due
+
+    def _serve_subscriptions(self):
+        """
+        Reply to parked subscriptions as their tasks finish, then return each
+        connection to the worker pool; on shutdown, reply to all of them and close
+        """
+        finished = self.task_processor.task_finished
+        while True:
+            with finished:
+                # Woken by every task completion; the timeout covers subscription deadlines
+                finished.wait_for(lambda: not self.running or self._due_subscriptions(), timeout=1.0)
+                stopping = not self.running
+                due = list(self._subscriptions) if stopping else self._due_subscriptions()
+                entries = [(sock, self._subscriptions.pop(sock)) for sock in due]
+                
+            for sock, (task_id, client_ip, _) in entries:
+                self._reply_to_subscription(sock, task_id, client_ip, resume=not stopping)
+            if stopping:
+                return
+
+    def _reply_to_subscription(self, client_socket: socket.socket, task_id: str,
+                               client_ip: str, resume: bool):
+        """Send a parked subscriber its task status, then resume or close the connection"""
+        status = self.task_processor.get_task_status(task_id)
+        if status:
+            sent = self.protocol.send_message(client_socket, json_data=status)
+        else:
+            self._send_error(client_socket, "Task not found")
+            sent = True
+            
+        if sent and resume:
+            with self._connections_lock:
+                self._connections += 1
+            try:
+                self._executor.submit(self.handle_client, client_socket, client_ip, 1)
+                return
+            except RuntimeError:
+                # The pool was shut down in the meantime
+                with self._connections_lock:
+                    self._connections -= 1
+        client_socket.close()
+
     def _handle_download(self, client_socket: socket.socket, request: Dict[str, Any]):
         """Handle processed file download request"""
         task_id = request.get('task_id')
@@ -232,26 +512,31 @@ class VideoProcessingServer:
         try:
             # Get task and verify output file
             task = self.task_processor.tasks[task_id]
-            if not task.output_path or not os.path.exists(task.output_path):
+            try:
+                # One stat for both the existence and the size check
+                output_size = os.stat(task.output_path).st_size if task.output_path else None
+            except FileNotFoundError:
+                output_size = None
+            if output_size is None:
                 raise FileNotFoundError(f"Output file not found: {task.output_path}")
                 
             # Verify file is not empty
-            if os.path.getsize(task.output_path) == 0:
+            if output_size == 0:
                 raise ValueError("Output file is empty")
 
-            # Read file data
-            with open(task.output_path, 'rb') as f:
-                file_data = f.read()
-                
             # Get media type from task
             media_type = task.output_media_type or os.path.splitext(task.output_path)[1][1:]
             
             # Send file
-            self.protocol.send_message(
+            sent = self.protocol.send_message(
                 client_socket,
                 media_type=media_type,
-                payload=file_data
+                payload_path=task.output_path,
+                drop_cache=True  # The server never rereads a delivered output
             )
+            if not sent:
+                # Keep the output so the client can retry the download
+                raise ConnectionError("Failed to send output file")
             
             # Log success
             self.logger.info(f"Successfully sent output file for task {task_id}")
@@ -278,15 +563,7 @@ class VideoProcessingServer:
 
     def _get_output_extension(self, task_type: str) -> str:
         """Get appropriate file extension for task type"""
-        extensions = {
-            'compress': 'mp4',
-            'resolution': 'mp4',
-            'aspect_ratio': 'mp4',
-            'extract_audio': 'mp3',
-            'gif': 'gif',
-            'webm': 'webm'
-        }
-        return extensions.get(task_type, 'mp4')
+        return self.OUTPUT_EXTENSIONS.get(task_type, 'mp4')
 
     def shutdown(self, signum=None, frame=None):
         """Gracefully shutdown the server"""
@@ -298,16 +575,31 @@ class VideoProcessingServer:
         
         self.running = False
         
+        # Wake the accept loop so it sees running is False right away
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+        
         # Stop task processor
         if hasattr(self, 'task_processor'):
             self.task_processor.shutdown()
             
+        # Answer parked subscribers (task_processor.shutdown wakes the waiter)
+        if self._subscription_thread:
+            self._subscription_thread.join()
+            
         # Close server socket
         if self.server_socket:
             self.server_socket.close()
             
+        # Let connection handlers finish; queued ones see running is False and
+        # just close their socket
+        self._executor.shutdown(wait=True)
+            
         # Final cleanup
         if hasattr(self, 'storage_manager'):
+            self.storage_manager.shutdown()
             self.storage_manager.cleanup_expired_files()
             
         self.logger.info("Server shutdown complete")
@@ -1,41 +1,84 @@
 # storage_manager.py
 
 import os
+import heapq
 import shutil
 import threading
+import time
 import logging
-from typing import Optional, Tuple, List, Dict
+from collections import defaultdict
+from typing import Optional, Tuple, List, Dict, Set
 from common.logging_config import LogConfig
 from datetime import datetime, timedelta
 
+NS_PER_HOUR = 3600 * 10**9
+
 class StorageManager:
     """Manages storage limits and temporary file handling"""
+
+    # How often the usage counter is re-synced with a full walk of work_dir
+    USAGE_RECONCILE_INTERVAL = 3600
     
     def __init__(self, work_dir: str, max_storage_bytes: int = 4 * 1024**4):
         self.work_dir = work_dir
         self.max_storage = max_storage_bytes
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # Serializes writers; readers don't take it
+        # Copy-on-write: writers publish a new dict (and new entry dicts) under
+        # self.lock, so readers can take a reference and iterate it without locking
         self.file_registry: Dict[str, Dict] = {}
+        self._task_index: Dict[str, Set[str]] = defaultdict(set)  # task_id -> file IDs
+        # Times in the registry and heaps are time.monotonic_ns() ints, which compare
+        # cheaply and don't jump with the wall clock; datetimes are only built for display
+        # (expires_at_ns, file_id) min-heap; entries left behind by remove_file or
+        # extend_file_expiry are stale and skipped when popped
+        self._expiry_heap: List[Tuple[int, str]] = []
+        # (created_at_ns, file_id) min-heap for evicting the oldest files first; stale
+        # entries are skipped when popped and dropped by _compact_age_heap
+        self._age_heap: List[Tuple[int, str]] = []
         self.logger = LogConfig.get_component_logger("StorageManager")
         
         if not os.path.exists(work_dir):
             os.makedirs(work_dir)
+
+        # Running usage total, maintained by register_file/remove_file
+        self._total_bytes = 0
+        self._last_reconcile = 0.0
+        self.reconcile_usage()
+
+        # Set by shutdown() to wake and stop the cleanup thread
+        self._stop_event = threading.Event()
             
         self._start_cleanup_thread()
 
     def _start_cleanup_thread(self):
         """Start background thread for periodic cleanup"""
         def cleanup_worker():
-            while True:
+            while not self._stop_event.is_set():
                 try:
                     self.cleanup_expired_files()
-                    threading.Event().wait(300)  # Run every 5 minutes
+                    if time.monotonic() - self._last_reconcile >= self.USAGE_RECONCILE_INTERVAL:
+                        self.reconcile_usage()
                 except Exception as e:
                     self.logger.error(f"Cleanup worker error: {e}")
+                # Wake for the next expiry, or every 5 minutes at most
+                self._stop_event.wait(self._seconds_until_next_expiry(300))
 
         self.cleanup_thread = threading.Thread(target=cleanup_worker, daemon=True)
         self.cleanup_thread.start()
 
+    def _seconds_until_next_expiry(self, limit: float) -> float:
+        """Seconds until the earliest registered file expires, capped at limit"""
+        with self.lock:
+            if not self._expiry_heap:
+                return limit
+            next_expiry = self._expiry_heap[0][0]
+        return max(0.0, min(limit, (next_expiry - time.monotonic_ns()) / 1e9))
+
+    def shutdown(self):
+        """Stop the background cleanup thread"""
+        self._stop_event.set()
+        self.cleanup_thread.join(timeout=5)
+
     def get_current_usage(self) -> int:
         """
         Get current storage usage in bytes
@@ -43,14 +86,44 @@ class StorageManager:
         Returns:
             int: Total bytes used
         """
+        with self.lock:
+            return self._total_bytes
+
+    def reconcile_usage(self) -> int:
+        """
+        Re-sync the usage counter with what is actually on disk.
+
+        Corrects drift from files that were written to work_dir without
+        being registered (e.g. processing outputs) or removed behind our back.
+
+        Returns:
+            int: Total bytes used
+        """
+        total = self._scan_usage()
+        with self.lock:
+            self._total_bytes = total
+            self._last_reconcile = time.monotonic()
+        return total
+
+    def _scan_usage(self) -> int:
+        """Walk work_dir and sum the size of every file in it"""
+        # scandir entries carry their full path, and their stat() reuses the
+        # directory read where possible, instead of a separate stat per path
         total = 0
-        for root, _, files in os.walk(self.work_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    total += os.path.getsize(file_path)
-                except OSError as e:
-                    self.logger.error(f"Error getting file size for {file_path}: {e}")
+        pending = [self.work_dir]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                total += entry.stat(follow_symlinks=False).st_size
+                        except OSError as e:
+                            self.logger.error(f"Error getting file size for {entry.path}: {e}")
+            except OSError as e:
+                self.logger.error(f"Error scanning directory: {e}")
         return total
 
     def check_storage_available(self, required_bytes: int) -> Tuple[bool, str]:
@@ -98,16 +171,22 @@ class StorageManager:
                 return None
                 
             file_id = f"{task_id}_{os.path.basename(file_path)}"
-            expiry_time = datetime.now() + timedelta(hours=expiry_hours)
+            created_at_ns = time.monotonic_ns()
+            expires_at_ns = created_at_ns + int(expiry_hours * NS_PER_HOUR)
             
             with self.lock:
-                self.file_registry[file_id] = {
+                self.file_registry = {**self.file_registry, file_id: {
                     'path': file_path,
                     'size': file_size,
                     'task_id': task_id,
-                    'created_at': datetime.now(),
-                    'expires_at': expiry_time
-                }
+                    'created_at': datetime.now(),  # For display only
+                    'created_at_ns': created_at_ns,
+                    'expires_at_ns': expires_at_ns
+                }}
+                heapq.heappush(self._age_heap, (created_at_ns, file_id))
+                self._task_index[task_id].add(file_id)
+                heapq.heappush(self._expiry_heap, (expires_at_ns, file_id))
+                self._total_bytes += file_size
                 
             self.logger.info(f"Registered file {file_id} of size {file_size}")
             return file_id
@@ -126,22 +205,33 @@ class StorageManager:
         Returns:
             bool: Success status
         """
-        with self.lock:
-            file_info = self.file_registry.get(file_id)
-            if not file_info:
-                return False
-                
-            try:
-                file_path = file_info['path']
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                del self.file_registry[file_id]
-                self.logger.info(f"Removed file {file_id}")
-                return True
+        file_info = self.file_registry.get(file_id)
+        if not file_info:
+            return False
+            
+        try:
+            # Delete the file outside the lock so other registry users aren't held up by IO
+            file_path = file_info['path']
+            if os.path.exists(file_path):
+                os.remove(file_path)
                 
-            except Exception as e:
-                self.logger.error(f"Error removing file {file_id}: {e}")
-                return False
+            with self.lock:
+                if file_id not in self.file_registry:
+                    return False  # Removed concurrently
+                registry = dict(self.file_registry)
+                del registry[file_id]
+                self.file_registry = registry
+                task_files = self._task_index[file_info['task_id']]
+                task_files.discard(file_id)
+                if not task_files:
+                    del self._task_index[file_info['task_id']]
+                self._total_bytes = max(0, self._total_bytes - file_info['size'])
+            self.logger.info(f"Removed file {file_id}")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"Error removing file {file_id}: {e}")
+            return False
 
     def cleanup_expired_files(self) -> int:
         """
@@ -150,20 +240,36 @@ class StorageManager:
         Returns:
             int: Number of files cleaned up
         """
-        current_time = datetime.now()
+        current_time = time.monotonic_ns()
         cleaned_count = 0
         
+        # Pop only the entries that are due, instead of scanning the whole registry
+        expired = []
         with self.lock:
-            file_ids = list(self.file_registry.keys())
-            for file_id in file_ids:
-                file_info = self.file_registry[file_id]
-                if current_time > file_info['expires_at']:
-                    if self.remove_file(file_id):
-                        cleaned_count += 1
+            while self._expiry_heap and self._expiry_heap[0][0] < current_time:
+                expires_at_ns, file_id = heapq.heappop(self._expiry_heap)
+                file_info = self.file_registry.get(file_id)
+                if file_info and file_info['expires_at_ns'] == expires_at_ns:
+                    expired.append(file_id)
+                    
+        # remove_file takes the lock itself
+        for file_id in expired:
+            if self.remove_file(file_id):
+                cleaned_count += 1
+                
+        self._compact_age_heap()
                         
         self.logger.info(f"Cleaned up {cleaned_count} expired files")
         return cleaned_count
 
+    def _compact_age_heap(self):
+        """Rebuild the age heap once stale entries make up most of it"""
+        with self.lock:
+            if len(self._age_heap) > 2 * len(self.file_registry) + 64:
+                self._age_heap = [(info['created_at_ns'], file_id)
+                                  for file_id, info in self.file_registry.items()]
+                heapq.heapify(self._age_heap)
+
     def cleanup_task_files(self, task_id: str) -> int:
         """
         Remove all files associated with a task
@@ -177,11 +283,12 @@ class StorageManager:
         cleaned_count = 0
         
         with self.lock:
-            file_ids = [fid for fid, info in self.file_registry.items() 
-                       if info['task_id'] == task_id]
-            for file_id in file_ids:
-                if self.remove_file(file_id):
-                    cleaned_count += 1
+            file_ids = list(self._task_index.get(task_id, ()))
+            
+        # remove_file takes the lock itself
+        for file_id in file_ids:
+            if self.remove_file(file_id):
+                cleaned_count += 1
                     
         return cleaned_count
 
@@ -206,6 +313,12 @@ class StorageManager:
             'disk_free': disk_stats.free
         }
 
+    @staticmethod
+    def _expiry_datetime(file_info: Dict) -> datetime:
+        """Wall-clock expiry time of a registry entry"""
+        lifetime_ns = file_info['expires_at_ns'] - file_info['created_at_ns']
+        return file_info['created_at'] + timedelta(microseconds=lifetime_ns // 1000)
+
     def get_file_info(self, file_id: str) -> Optional[Dict]:
         """
         Get information about a registered file
@@ -216,16 +329,15 @@ class StorageManager:
         Returns:
             Optional[Dict]: File information if found
         """
-        with self.lock:
-            file_info = self.file_registry.get(file_id)
-            if file_info:
-                return {
-                    'path': file_info['path'],
-                    'size': file_info['size'],
-                    'task_id': file_info['task_id'],
-                    'created_at': file_info['created_at'].isoformat(),
-                    'expires_at': file_info['expires_at'].isoformat()
-                }
+        file_info = self.file_registry.get(file_id)
+        if file_info:
+            return {
+                'path': file_info['path'],
+                'size': file_info['size'],
+                'task_id': file_info['task_id'],
+                'created_at': file_info['created_at'].isoformat(),
+                'expires_at': self._expiry_datetime(file_info).isoformat()
+            }
         return None
 
     def extend_file_expiry(self, file_id: str, additional_hours: int) -> bool:
@@ -242,7 +354,10 @@ class StorageManager:
         with self.lock:
             file_info = self.file_registry.get(file_id)
             if file_info:
-                file_info['expires_at'] += timedelta(hours=additional_hours)
+                file_info = {**file_info,
+                             'expires_at_ns': file_info['expires_at_ns'] + int(additional_hours * NS_PER_HOUR)}
+                self.file_registry = {**self.file_registry, file_id: file_info}
+                heapq.heappush(self._expiry_heap, (file_info['expires_at_ns'], file_id))
                 self.logger.info(f"Extended expiry for {file_id} by {additional_hours} hours")
                 return True
         return False
@@ -254,12 +369,11 @@ class StorageManager:
         Returns:
             List[str]: List of expired file IDs
         """
-        current_time = datetime.now()
-        with self.lock:
-            return [
-                file_id for file_id, info in self.file_registry.items()
-                if current_time > info['expires_at']
-            ]
+        current_time = time.monotonic_ns()
+        return [
+            file_id for file_id, info in self.file_registry.items()
+            if current_time > info['expires_at_ns']
+        ]
 
     def emergency_cleanup(self, required_bytes: int) -> Tuple[bool, int]:
         """
@@ -274,22 +388,31 @@ class StorageManager:
         freed_bytes = 0
         
         # First, cleanup all expired files
+        registry = self.file_registry
         expired_files = self.get_expired_files()
         for file_id in expired_files:
             if self.remove_file(file_id):
-                freed_bytes += self.file_registry[file_id]['size']
+                freed_bytes += registry[file_id]['size']
                 
-        # If still need more space, remove oldest files
-        if freed_bytes < required_bytes:
+        # If still need more space, remove oldest files, popping them off the age
+        # heap one at a time instead of sorting the whole registry
+        kept = []
+        while freed_bytes < required_bytes:
             with self.lock:
-                files = sorted(
-                    self.file_registry.items(),
-                    key=lambda x: x[1]['created_at']
-                )
-                for file_id, info in files:
-                    if self.remove_file(file_id):
-                        freed_bytes += info['size']
-                    if freed_bytes >= required_bytes:
-                        break
+                if not self._age_heap:
+                    break
+                created_at_ns, file_id = heapq.heappop(self._age_heap)
+                info = self.file_registry.get(file_id)
+            if not info or info['created_at_ns'] != created_at_ns:
+                continue  # Stale: removed or registered again since
+            if self.remove_file(file_id):
+                freed_bytes += info['size']
+            else:
+                kept.append((created_at_ns, file_id))
+                
+        # Files that couldn't be removed stay candidates for next time
+        with self.lock:
+            for entry in kept:
+                heapq.heappush(self._age_heap, entry)
                         
         return freed_bytes >= required_bytes, freed_bytes
\ No newline at end of file
@@ -2,11 +2,13 @@
 
 import threading
 import queue
+import heapq
+import itertools
 import logging
 import time
 import os
 import uuid
-from typing import Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Optional, List, Tuple
 from datetime import datetime
 from dataclasses import dataclass
 from common.logging_config import LogConfig
@@ -26,11 +28,83 @@ class Task:
     parameters: Dict[str, Any]
     error: Optional[str] = None
     output_media_type: Optional[str] = None
+    completed_at_ns: Optional[int] = None  # time.monotonic_ns() at completion, for age checks
+
+class TaskQueue:
+    """
+    Bounded priority queue of task IDs: a heap guarded by one Condition
+    
+    Entries are (priority, sequence, task_id); the sequence number keeps tasks
+    of equal priority in FIFO order without ever comparing task IDs.
+    """
+    
+    def __init__(self, maxsize: int = 0):
+        """
+        Args:
+            maxsize: Maximum queued tasks (0 = unbounded)
+        """
+        self.maxsize = maxsize
+        self._heap: List[Tuple[int, int, str]] = []
+        self._seq = itertools.count()
+        self._not_empty = threading.Condition()
+        self._closed = False
+
+    def put(self, priority: int, task_id: str):
+        """
+        Queue a task
+        
+        Raises:
+            queue.Full: If the queue is closed or already holds maxsize tasks
+        """
+        with self._not_empty:
+            if self._closed or (self.maxsize and len(self._heap) >= self.maxsize):
+                raise queue.Full
+            heapq.heappush(self._heap, (priority, next(self._seq), task_id))
+            self._not_empty.notify()
+
+    def get(self) -> Optional[Tuple[int, str]]:
+        """
+        Remove and return the highest-priority (lowest number) task,
+        blocking until one is queued
+        
+        Returns:
+            Optional[Tuple[int, str]]: (priority, task ID), or None once the
+            queue is closed (the stop signal for workers)
+        """
+        with self._not_empty:
+            self._not_empty.wait_for(lambda: self._heap or self._closed)
+            if self._closed:
+                return None
+            priority, _, task_id = heapq.heappop(self._heap)
+            return priority, task_id
+
+    def close(self):
+        """Wake every waiting get() with None; queued tasks are abandoned"""
+        with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
+
+    def qsize(self) -> int:
+        """Number of queued tasks (len() of a list is atomic, no lock needed)"""
+        return len(self._heap)
 
 class TaskProcessor:
     """Manages video processing tasks and their status"""
     
-    def __init__(self, video_processor, performance_manager, max_queue_size: int = 100):
+    # Per task type: (queue priority, output extension, VideoProcessor method,
+    # task parameters passed to it after the input and output paths)
+    # Lower priority number = higher priority
+    TASK_TYPES = {
+        'compress': (1, 'mp4', 'compress_video', ()),
+        'extract_audio': (2, 'mp3', 'extract_audio', ()),
+        'resolution': (3, 'mp4', 'change_resolution', ('width', 'height')),
+        'aspect_ratio': (3, 'mp4', 'change_aspect_ratio', ('aspect_ratio',)),
+        'gif': (4, 'gif', 'create_gif', ('start_time', 'duration')),
+        'webm': (4, 'webm', 'create_webm', ('start_time', 'duration'))
+    }
+    
+    def __init__(self, video_processor, performance_manager, max_queue_size: int = 100,
+                 num_workers: int = 2, on_task_completed: Optional[Callable[[Task], None]] = None):
         """
         Initialize task processor
         
@@ -38,53 +112,76 @@ class TaskProcessor:
             video_processor: VideoProcessor instance
             performance_manager: PerformanceManager instance
             max_queue_size: Maximum tasks in queue
+            num_workers: Number of tasks (FFmpeg processes) run concurrently
+            on_task_completed: Called with each successful task once its output is
+                verified, before the task is reported as completed
         """
         self.video_processor = video_processor
         self.performance_manager = performance_manager
-        self.task_queue = queue.PriorityQueue(maxsize=max_queue_size)
+        self.on_task_completed = on_task_completed
+        # Bound VideoProcessor method for each task type, looked up once
+        self._handlers = {
+            task_type: getattr(video_processor, method_name)
+            for task_type, (_, _, method_name, _) in self.TASK_TYPES.items()
+        }
+        self.task_queue = TaskQueue(maxsize=max_queue_size)
         self.tasks: Dict[str, Task] = {}
         self.active_tasks: Dict[str, str] = {}  # IP -> Task ID mapping
         self.lock = threading.Lock()
+        self.task_finished = threading.Condition()  # Notified whenever a task completes or fails
         self.shutdown_flag = threading.Event()
+        self._running_tasks = 0  # Tasks currently in _process_task
         self.logger = LogConfig.get_component_logger("TaskProcessor")
-        self._start_worker()
+        self._start_workers(num_workers)
 
-    def _start_worker(self):
-        """Start worker thread for processing tasks"""
+    def _start_workers(self, num_workers: int):
+        """
+        Start worker threads for processing tasks
+        
+        Each worker takes the highest-priority queued task and blocks in FFmpeg
+        while it runs (the GIL is released while waiting on the child process),
+        so num_workers tasks are encoded in parallel.
+        """
         def worker():
-            while not self.shutdown_flag.is_set():
+            while True:
+                # Sleeps until a task is queued; None means shutdown closed the queue
+                item = self.task_queue.get()
+                if item is None:
+                    break
                 try:
-                    # Get task with timeout to check shutdown flag periodically
-                    priority, task_id = self.task_queue.get(timeout=1.0)
+                    priority, task_id = item
                     task = self.tasks[task_id]
                     
                     # Process task
                     self._process_task(task)
                     
-                    # Clean up IP restriction
-                    with self.lock:
-                        if task.ip_address in self.active_tasks:
-                            del self.active_tasks[task.ip_address]
+                    # Clean up IP restriction (pop is atomic, like add_task's setdefault)
+                    # before waking waiters, so a subscriber can upload its next file at once
+                    self.active_tasks.pop(task.ip_address, None)
+                    with self.task_finished:
+                        self.task_finished.notify_all()
                     
-                    self.task_queue.task_done()
-                    
-                except queue.Empty:
-                    continue
                 except Exception as e:
                     self.logger.error(f"Worker error: {e}")
 
-        self.worker_thread = threading.Thread(target=worker, daemon=True)
-        self.worker_thread.start()
+        self.worker_threads = [
+            threading.Thread(target=worker, name=f"task-worker-{i}", daemon=True)
+            for i in range(max(1, num_workers))
+        ]
+        for thread in self.worker_threads:
+            thread.start()
 
     def _process_task(self, task: Task):
         """Process a single task"""
         self.logger.info(f"Processing task {task.id} of type {task.type}")
         task.status = 'processing'
         task.started_at = datetime.now()
+        with self.lock:
+            self._running_tasks += 1
 
         try:
             # Check system resources
-            can_process, error_msg = self.performance_manager.can_process_new_task()
+            can_process, error_msg = self._wait_for_resources()
             if not can_process:
                 raise RuntimeError(f"Insufficient resources: {error_msg}")
 
@@ -97,45 +194,30 @@ class TaskProcessor:
             task.output_media_type = output_ext
 
             # Process based on task type
-            success = False
-            if task.type == 'compress':
-                success = self.video_processor.compress_video(
-                    task.input_path, task.output_path
-                )
-            elif task.type == 'resolution':
-                success = self.video_processor.change_resolution(
-                    task.input_path, task.output_path,
-                    task.parameters['width'],
-                    task.parameters['height']
-                )
-            elif task.type == 'aspect_ratio':
-                success = self.video_processor.change_aspect_ratio(
-                    task.input_path, task.output_path,
-                    task.parameters['aspect_ratio']
-                )
-            elif task.type == 'extract_audio':
-                success = self.video_processor.extract_audio(
-                    task.input_path, task.output_path
-                )
-            elif task.type in ['gif', 'webm']:
-                method = (self.video_processor.create_gif 
-                         if task.type == 'gif' 
-                         else self.video_processor.create_webm)
-                success = method(
-                    task.input_path, task.output_path,
-                    task.parameters['start_time'],
-                    task.parameters['duration']
-                )
-            else:
+            handler = self._handlers.get(task.type)
+            if not handler:
                 raise ValueError(f"Unknown task type: {task.type}")
+            param_keys = self.TASK_TYPES[task.type][3]
+            success = handler(
+                task.input_path, task.output_path,
+                *(task.parameters[key] for key in param_keys)
+            )
 
             if success:
-                # Verify file exists and is not empty
-                if not os.path.exists(task.output_path):
+                # Verify file exists and is not empty (one stat call for both)
+                try:
+                    output_size = os.stat(task.output_path).st_size
+                except FileNotFoundError:
                     raise RuntimeError("Output file was not created")
-                if os.path.getsize(task.output_path) == 0:
+                if output_size == 0:
                     raise RuntimeError("Output file is empty")
                 
+                if self.on_task_completed:
+                    try:
+                        self.on_task_completed(task)
+                    except Exception as e:
+                        self.logger.warning(f"Completion callback failed for task {task.id}: {e}")
+                
                 task.status = 'completed'
                 self.logger.info(f"Task {task.id} completed successfully")
             else:
@@ -148,9 +230,30 @@ class TaskProcessor:
 
         finally:
             task.completed_at = datetime.now()
+            task.completed_at_ns = time.monotonic_ns()
+            with self.lock:
+                self._running_tasks -= 1
+
+    def _wait_for_resources(self) -> Tuple[bool, Optional[str]]:
+        """
+        Check system resources for a new task
+        
+        While other tasks are running, a shortfall is most likely caused by them,
+        so wait for one to finish and check again instead of failing the task.
+        
+        Returns:
+            Tuple[bool, Optional[str]]: (can process, error message if any)
+        """
+        while True:
+            can_process, error_msg = self.performance_manager.can_process_new_task()
+            if can_process or self._running_tasks <= 1 or self.shutdown_flag.is_set():
+                return can_process, error_msg
+            with self.task_finished:
+                self.task_finished.wait(5.0)
 
     def add_task(self, ip_address: str, task_type: str, input_path: str, 
-                 output_path: str, parameters: Dict[str, Any] = None) -> Optional[str]:
+                 output_path: str, parameters: Dict[str, Any] = None,
+                 task_id: Optional[str] = None) -> Optional[str]:
         """
         Add a new task to the queue
         
@@ -160,45 +263,60 @@ class TaskProcessor:
             input_path: Input file path
             output_path: Output file path
             parameters: Additional parameters for the task
+            task_id: ID to give the task (generated if omitted), for callers that
+                need it before the task exists
             
         Returns:
             Optional[str]: Task ID if successful, None if failed
         """
+        # Reject unknown types before they take an IP slot or a queue entry
+        if task_type not in self.TASK_TYPES:
+            self.logger.warning(f"Unknown task type: {task_type}")
+            return None
+
+        task_id = task_id or str(uuid.uuid4())
+
+        # Reserve the IP's single active-task slot without taking self.lock:
+        # setdefault is atomic and returns the existing task ID if one is set
+        if self.active_tasks.setdefault(ip_address, task_id) != task_id:
+            self.logger.warning(f"IP {ip_address} already has an active task")
+            return None
+
         try:
+            # Create new task
+            task = Task(
+                id=task_id,
+                type=task_type,
+                status='queued',
+                created_at=datetime.now(),
+                started_at=None,
+                completed_at=None,
+                input_path=input_path,
+                output_path=output_path,
+                ip_address=ip_address,
+                parameters=parameters or {}
+            )
+
+            # cleanup_completed_tasks swaps self.tasks under the lock, so the
+            # insert must not race with it
             with self.lock:
-                # Check if IP already has an active task
-                if ip_address in self.active_tasks:
-                    self.logger.warning(f"IP {ip_address} already has an active task")
-                    return None
-
-                # Create new task
-                task_id = str(uuid.uuid4())
-                task = Task(
-                    id=task_id,
-                    type=task_type,
-                    status='queued',
-                    created_at=datetime.now(),
-                    started_at=None,
-                    completed_at=None,
-                    input_path=input_path,
-                    output_path=output_path,
-                    ip_address=ip_address,
-                    parameters=parameters or {}
-                )
-
-                # Add to tracking collections
                 self.tasks[task_id] = task
-                self.active_tasks[ip_address] = task_id
 
-                # Add to processing queue with priority based on task type
-                priority = self._get_task_priority(task_type)
-                self.task_queue.put((priority, task_id))
+            # Add to processing queue with priority based on task type
+            priority = self._get_task_priority(task_type)
+            self.task_queue.put(priority, task_id)
 
-                self.logger.info(f"Added task {task_id} for IP {ip_address}")
-                return task_id
+            self.logger.info(f"Added task {task_id} for IP {ip_address}")
+            return task_id
 
         except Exception as e:
-            self.logger.error(f"Error adding task: {e}")
+            if isinstance(e, queue.Full):
+                self.logger.warning(f"Task queue is full, rejecting task for IP {ip_address}")
+            else:
+                self.logger.error(f"Error adding task: {e}")
+            with self.lock:
+                self.tasks.pop(task_id, None)
+            self.active_tasks.pop(ip_address, None)
             return None
 
     def get_task_status(self, task_id: str) -> Optional[Dict[str, Any]]:
@@ -224,6 +342,29 @@ class TaskProcessor:
             'error': task.error
         }
 
+    def wait_for_task(self, task_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Wait until a task has completed or failed
+        
+        Args:
+            task_id: Task identifier
+            timeout: Maximum time to wait in seconds
+            
+        Returns:
+            Optional[Dict]: Task status information (still queued/processing if
+            the timeout expired), None if the task is unknown
+        """
+        task = self.tasks.get(task_id)
+        if not task:
+            return None
+
+        with self.task_finished:
+            self.task_finished.wait_for(
+                lambda: task.status in ('completed', 'failed'),
+                timeout
+            )
+        return self.get_task_status(task_id)
+
     def get_queue_status(self) -> Dict[str, Any]:
         """
         Get current queue status
@@ -231,12 +372,12 @@ class TaskProcessor:
         Returns:
             Dict containing queue statistics
         """
-        with self.lock:
-            return {
-                'queue_size': self.task_queue.qsize(),
-                'active_tasks': len(self.active_tasks),
-                'total_tasks': len(self.tasks)
-            }
+        # len() of a dict is atomic, so these reads don't need self.lock
+        return {
+            'queue_size': self.task_queue.qsize(),
+            'active_tasks': len(self.active_tasks),
+            'total_tasks': len(self.tasks)
+        }
 
     def get_active_tasks_by_ip(self) -> Dict[str, List[str]]:
         """
@@ -245,13 +386,13 @@ class TaskProcessor:
         Returns:
             Dict mapping IP addresses to lists of task IDs
         """
-        with self.lock:
-            tasks_by_ip = {}
-            for ip, task_id in self.active_tasks.items():
-                if task_id not in tasks_by_ip:
-                    tasks_by_ip[ip] = []
-                tasks_by_ip[ip].append(task_id)
-            return tasks_by_ip
+        # Iterate over a snapshot (copying a dict is atomic) rather than holding self.lock
+        tasks_by_ip = {}
+        for ip, task_id in dict(self.active_tasks).items():
+            if task_id not in tasks_by_ip:
+                tasks_by_ip[ip] = []
+            tasks_by_ip[ip].append(task_id)
+        return tasks_by_ip
 
     def _get_task_priority(self, task_type: str) -> int:
         """
@@ -264,15 +405,8 @@ class TaskProcessor:
         Returns:
             int: Priority level
         """
-        priorities = {
-            'compress': 1,
-            'extract_audio': 2,
-            'resolution': 3,
-            'aspect_ratio': 3,
-            'gif': 4,
-            'webm': 4
-        }
-        return priorities.get(task_type, 10)
+        meta = self.TASK_TYPES.get(task_type)
+        return meta[0] if meta else 10
 
     def _get_output_extension(self, task_type: str) -> str:
         """
@@ -284,15 +418,8 @@ class TaskProcessor:
         Returns:
             str: File extension
         """
-        extensions = {
-            'compress': 'mp4',
-            'resolution': 'mp4',
-            'aspect_ratio': 'mp4',
-            'extract_audio': 'mp3',
-            'gif': 'gif',
-            'webm': 'webm'
-        }
-        return extensions.get(task_type, 'mp4')
+        meta = self.TASK_TYPES.get(task_type)
+        return meta[1] if meta else 'mp4'
 
     def cleanup_completed_tasks(self, max_age_hours: int = 24):
         """
@@ -301,20 +428,23 @@ class TaskProcessor:
         Args:
             max_age_hours: Maximum age of completed tasks to keep
         """
-        current_time = datetime.now()
+        cutoff_ns = time.monotonic_ns() - int(max_age_hours * 3600 * 10**9)
         with self.lock:
-            task_ids = list(self.tasks.keys())
-            for task_id in task_ids:
-                task = self.tasks[task_id]
-                if task.completed_at:
-                    age = current_time - task.completed_at
-                    if age.total_seconds() > max_age_hours * 3600:
-                        del self.tasks[task_id]
+            # Rebuild in one pass and swap the reference; lock-free readers
+            # keep using whichever dict they already hold
+            self.tasks = {
+                task_id: task for task_id, task in self.tasks.items()
+                if task.completed_at_ns is None or task.completed_at_ns >= cutoff_ns
+            }
 
     def shutdown(self):
         """Gracefully shutdown the task processor"""
         self.logger.info("Shutting down task processor...")
         self.shutdown_flag.set()
-        if hasattr(self, 'worker_thread'):
-            self.worker_thread.join()
+        self.task_queue.close()
+        # Wake workers waiting in _wait_for_resources
+        with self.task_finished:
+            self.task_finished.notify_all()
+        for thread in getattr(self, 'worker_threads', []):
+            thread.join()
         self.logger.info("Task processor shutdown complete")
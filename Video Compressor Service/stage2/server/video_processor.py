@@ -2,18 +2,59 @@
 
 import os
 import subprocess
-import json
 import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
 from typing import Dict, Any, Tuple, Optional
 from common.logging_config import LogConfig
+from common.mmp_protocol import json_loads  # orjson when installed
 import shutil
 
 class VideoProcessor:
     """Video processing service using FFmpeg"""
     
-    def __init__(self, work_dir: str):
+    PROBE_CACHE_SIZE = 128  # Max analyze_video results kept
+    PROBE_CACHE_TTL = 600  # Seconds an analyze_video result stays valid
+    
+    # Compression tiers by resolution:
+    # (max pixels, bitrate threshold, CRF above threshold, CRF at or below, preset)
+    COMPRESSION_TIERS = (
+        (1280 * 720, 2_000_000, 23, 26, 'medium'),   # 720p or lower
+        (1920 * 1080, 4_000_000, 22, 24, 'medium'),  # 1080p
+        (None, 8_000_000, 20, 22, 'slower'),         # 4K or higher
+    )
+    _TIER_PIXELS = tuple(tier[0] for tier in COMPRESSION_TIERS[:-1])
+    
+    # Fixed parts of the FFprobe/FFmpeg command lines, built once
+    _FFPROBE_CMD = ('ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams')
+    _FFMPEG_PREFIX = ('ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error')
+    _COMPRESS_ARGS = ('-c:v', 'libx264', '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart')
+    _REENCODE_ARGS = ('-c:v', 'libx264', '-crf', '23', '-c:a', 'copy')
+    _AUDIO_ARGS = ('-vn', '-acodec', 'libmp3lame', '-q:a', '2')
+    _GIF_ARGS = (
+        '-filter_complex',
+        # Generate the palette and apply it in one pass: the segment is decoded
+        # once and split between palettegen and paletteuse inside FFmpeg
+        'fps=10,scale=320:-1:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse',
+    )
+    _WEBM_ARGS = ('-c:v', 'libvpx-vp9', '-crf', '30', '-b:v', '0', '-c:a', 'libopus')
+    
+    def __init__(self, work_dir: str, ffmpeg_threads: int = 0):
+        """
+        Args:
+            work_dir: Working directory for temporary files
+            ffmpeg_threads: Threads per FFmpeg process (0 = FFmpeg's default), so
+                concurrent tasks share the cores instead of each claiming all of them
+        """
         self.work_dir = work_dir
+        self.ffmpeg_threads = ffmpeg_threads
+        self._thread_args = ('-threads', str(ffmpeg_threads)) if ffmpeg_threads else ()
         self.logger = LogConfig.get_component_logger("VideoProcessor")
+        # LRU of analyze_video results: (path, mtime_ns, size) -> (info, expires_at)
+        self._probe_cache = OrderedDict()
+        self._probe_cache_lock = threading.Lock()
         self._verify_ffmpeg()
 
     def _verify_ffmpeg(self):
@@ -23,6 +64,33 @@ class VideoProcessor:
         except (subprocess.SubprocessError, FileNotFoundError):
             raise RuntimeError("FFmpeg is not installed or accessible")
 
+    def _run_ffmpeg(self, args: Tuple[str, ...], output_path: str):
+        """
+        Run FFmpeg with the given input/processing arguments, writing output_path
+        
+        Args:
+            args: Arguments between the common prefix and the output options
+            output_path: Output file path
+        
+        The calling worker thread sleeps in the kernel (pipe read / waitpid)
+        without holding the GIL, so other threads keep serving requests.
+        Only FFmpeg's error output is captured, to report why a command failed.
+        
+        Raises:
+            RuntimeError: If FFmpeg exits with a non-zero status
+        """
+        cmd = (*self._FFMPEG_PREFIX, *args, *self._thread_args, output_path)
+        proc = subprocess.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        if proc.returncode != 0:
+            err = proc.stderr.decode(errors='replace').strip().splitlines()
+            detail = err[-1] if err else 'no error output'
+            raise RuntimeError(f"FFmpeg exited with status {proc.returncode}: {detail}")
+
     def analyze_video(self, input_path: str) -> Dict[str, Any]:
         """
         Analyze video characteristics using FFprobe
@@ -33,18 +101,33 @@ class VideoProcessor:
         Returns:
             Dict containing video information
         """
+        # Reuse a recent result for the same, unmodified file instead of running ffprobe again
+        st = os.stat(input_path)
+        key = (input_path, st.st_mtime_ns, st.st_size)
+        now = time.monotonic()
+        with self._probe_cache_lock:
+            entry = self._probe_cache.get(key)
+            if entry and entry[1] > now:
+                self._probe_cache.move_to_end(key)
+                return entry[0]
+                
+        info = self._probe_video(input_path)
+        
+        with self._probe_cache_lock:
+            self._probe_cache[key] = (info, now + self.PROBE_CACHE_TTL)
+            self._probe_cache.move_to_end(key)
+            while len(self._probe_cache) > self.PROBE_CACHE_SIZE:
+                self._probe_cache.popitem(last=False)
+        return info
+
+    def _probe_video(self, input_path: str) -> Dict[str, Any]:
+        """Run FFprobe on input_path and extract the fields analyze_video returns"""
         try:
-            cmd = [
-                'ffprobe',
-                '-v', 'quiet',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                input_path
-            ]
+            cmd = (*self._FFPROBE_CMD, input_path)
             
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            info = json.loads(result.stdout)
+            # Keep stdout as bytes; the JSON parser decodes it itself
+            result = subprocess.run(cmd, capture_output=True, check=True)
+            info = json_loads(result.stdout)
             
             video_stream = next(s for s in info['streams'] if s['codec_type'] == 'video')
             
@@ -57,7 +140,7 @@ class VideoProcessor:
                     'codec': video_stream.get('codec_name', ''),
                     'width': int(video_stream.get('width', 0)),
                     'height': int(video_stream.get('height', 0)),
-                    'fps': eval(video_stream.get('r_frame_rate', '0/1')),
+                    'fps': self._parse_rate(video_stream.get('r_frame_rate', '0/1')),
                     'bitrate': int(video_stream.get('bit_rate', 0))
                 }
             }
@@ -66,6 +149,21 @@ class VideoProcessor:
             self.logger.error(f"Error analyzing video: {e}")
             raise
 
+    @staticmethod
+    def _parse_rate(rate: str) -> float:
+        """
+        Parse an FFprobe rational such as '30000/1001' without evaluating it
+        
+        Args:
+            rate: Rational string ('num/den') or plain number
+            
+        Returns:
+            float: The rate, or 0.0 if the denominator is zero
+        """
+        num, _, den = rate.partition('/')
+        den = int(den) if den else 1
+        return int(num) / den if den else 0.0
+
     def _get_optimal_compression_params(self, video_info: Dict[str, Any]) -> Dict[str, str]:
         """
         Determine optimal compression parameters based on video characteristics
@@ -80,19 +178,11 @@ class VideoProcessor:
         pixels = video['width'] * video['height']
         input_bitrate = video['bitrate']
 
-        # Select CRF (Constant Rate Factor) based on resolution and current bitrate
-        if pixels <= 1280 * 720:  # 720p or lower
-            crf = 23 if input_bitrate > 2_000_000 else 26
-        elif pixels <= 1920 * 1080:  # 1080p
-            crf = 22 if input_bitrate > 4_000_000 else 24
-        else:  # 4K or higher
-            crf = 20 if input_bitrate > 8_000_000 else 22
-
-        # Select encoder preset based on resolution
-        if pixels > 1920 * 1080:
-            preset = 'slower'  # Higher quality for 4K
-        else:
-            preset = 'medium'  # Balanced for 1080p and below
+        # Pick the first tier whose pixel limit covers the input, then select
+        # CRF (Constant Rate Factor) from the current bitrate
+        _, bitrate_threshold, crf_high, crf_low, preset = \
+            self.COMPRESSION_TIERS[bisect_left(self._TIER_PIXELS, pixels)]
+        crf = crf_high if input_bitrate > bitrate_threshold else crf_low
 
         return {
             'crf': str(crf),
@@ -118,19 +208,15 @@ class VideoProcessor:
             info = self.analyze_video(input_path)
             params = self._get_optimal_compression_params(info)
             
-            cmd = [
-                'ffmpeg', '-i', input_path,
-                '-c:v', 'libx264',
+            args = (
+                '-i', input_path,
                 '-crf', params['crf'],
                 '-preset', params['preset'],
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-movflags', '+faststart',
-                output_path
-            ]
+                *self._COMPRESS_ARGS
+            )
             
             self.logger.info(f"Compressing video with parameters: {params}")
-            subprocess.run(cmd, check=True)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e:
@@ -151,17 +237,14 @@ class VideoProcessor:
             bool: Success status
         """
         try:
-            cmd = [
-                'ffmpeg', '-i', input_path,
+            args = (
+                '-i', input_path,
                 '-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2',
-                '-c:v', 'libx264',
-                '-crf', '23',
-                '-c:a', 'copy',
-                output_path
-            ]
+                *self._REENCODE_ARGS
+            )
             
             self.logger.info(f"Changing resolution to {width}x{height}")
-            subprocess.run(cmd, check=True)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e:
@@ -184,17 +267,14 @@ class VideoProcessor:
             # Parse aspect ratio
             width_ratio, height_ratio = map(int, aspect_ratio.split(':'))
             
-            cmd = [
-                'ffmpeg', '-i', input_path,
+            args = (
+                '-i', input_path,
                 '-vf', f'setdar={width_ratio}/{height_ratio}',
-                '-c:v', 'libx264',
-                '-crf', '23',
-                '-c:a', 'copy',
-                output_path
-            ]
+                *self._REENCODE_ARGS
+            )
             
             self.logger.info(f"Changing aspect ratio to {aspect_ratio}")
-            subprocess.run(cmd, check=True)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e:
@@ -213,16 +293,10 @@ class VideoProcessor:
             bool: Success status
         """
         try:
-            cmd = [
-                'ffmpeg', '-i', input_path,
-                '-vn',
-                '-acodec', 'libmp3lame',
-                '-q:a', '2',
-                output_path
-            ]
+            args = ('-i', input_path, *self._AUDIO_ARGS)
             
             self.logger.info("Extracting audio to MP3")
-            subprocess.run(cmd, check=True)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e:
@@ -243,40 +317,19 @@ class VideoProcessor:
             bool: Success status
         """
         try:
-            # Generate palette for better quality
-            palette_path = os.path.join(self.work_dir, 'palette.png')
-            
-            # Generate palette
-            palette_cmd = [
-                'ffmpeg', '-ss', str(start_time),
+            args = (
+                '-ss', str(start_time),
                 '-t', str(duration),
                 '-i', input_path,
-                '-vf', 'fps=10,scale=320:-1:flags=lanczos,palettegen',
-                palette_path
-            ]
-            
-            # Create GIF using palette
-            gif_cmd = [
-                'ffmpeg', '-ss', str(start_time),
-                '-t', str(duration),
-                '-i', input_path,
-                '-i', palette_path,
-                '-filter_complex', 'fps=10,scale=320:-1:flags=lanczos[x];[x][1:v]paletteuse',
-                output_path
-            ]
+                *self._GIF_ARGS
+            )
             
             self.logger.info(f"Creating GIF from {start_time}s to {start_time + duration}s")
-            subprocess.run(palette_cmd, check=True)
-            subprocess.run(gif_cmd, check=True)
-            
-            # Clean up palette
-            os.remove(palette_path)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e:
             self.logger.error(f"Error creating GIF: {e}")
-            if os.path.exists(palette_path):
-                os.remove(palette_path)
             return False
 
     def create_webm(self, input_path: str, output_path: str, start_time: float, duration: float) -> bool:
@@ -293,19 +346,15 @@ class VideoProcessor:
             bool: Success status
         """
         try:
-            cmd = [
-                'ffmpeg', '-ss', str(start_time),
+            args = (
+                '-ss', str(start_time),
                 '-t', str(duration),
                 '-i', input_path,
-                '-c:v', 'libvpx-vp9',
-                '-crf', '30',
-                '-b:v', '0',
-                '-c:a', 'libopus',
-                output_path
-            ]
+                *self._WEBM_ARGS
+            )
             
             self.logger.info(f"Creating WebM from {start_time}s to {start_time + duration}s")
-            subprocess.run(cmd, check=True)
+            self._run_ffmpeg(args, output_path)
             return True
             
         except Exception as e: